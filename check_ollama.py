@@ -4,75 +4,211 @@ Ollama環境診断スクリプト
 接続とモデルの状態を確認
 """
 
+import io
+import itertools
+import os
 import sys
 import json
-import subprocess
-from typing import Dict, List, Any
+import time
+import asyncio
+import argparse
+import shutil
+import functools
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Any, Tuple
 
-try:
-    import ollama
+OLLAMA_HOST = "localhost"
+OLLAMA_PORT = 11434
+
+# ローカル向けの短いタイムアウト（接続0.5秒・読み込み2秒）
+# ollamaパッケージ既定値のままだと応答しないデーモンで長時間待たされる
+CONNECT_TIMEOUT = 0.5
+PROBE_READ_TIMEOUT = 2.0
+INFERENCE_READ_TIMEOUT = 10.0
+
+def import_ollama() -> bool:
+    """ollamaパッケージを読み込む（起動時間短縮のため使用直前まで遅延）
+    
+    Returns:
+        読み込めた場合True、未インストールの場合は案内を表示してFalse
+    """
+    try:
+        import ollama  # noqa: F401
+    except ImportError:
+        print("❌ ollamaパッケージ: 未インストール")
+        print("   実行: pip install ollama")
+        return False
     print("✅ ollamaパッケージ: インポート成功")
-except ImportError:
-    print("❌ ollamaパッケージ: 未インストール")
-    print("   実行: pip install ollama")
-    sys.exit(1)
+    return True
+
+@functools.lru_cache(maxsize=None)
+def _clients() -> Tuple[Any, Any]:
+    """共有クライアント (確認用, --deep推論用) を初回使用時に生成"""
+    import httpx
+    import ollama
+    
+    host = f"http://{OLLAMA_HOST}:{OLLAMA_PORT}"
+    # 全ての確認で接続プールを共有するクライアント
+    probe = ollama.Client(host=host, timeout=httpx.Timeout(PROBE_READ_TIMEOUT, connect=CONNECT_TIMEOUT))
+    # 生成に時間がかかるため読み込みタイムアウトを長めに
+    inference = ollama.Client(host=host, timeout=httpx.Timeout(INFERENCE_READ_TIMEOUT, connect=CONNECT_TIMEOUT))
+    return probe, inference
+
+# ollama.list()結果のディスクキャッシュ
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "gemma3-dialogue", "ollama_models.json")
+CACHE_MAX_AGE = 60  # 秒（pull直後の再実行で古い一覧を見せないよう短く）
+
+def _has_gemma(payload: Dict[str, Any]) -> bool:
+    """キャッシュしたモデル一覧にGemmaモデルが含まれるか"""
+    return any(
+        'gemma' in str(m.get("model") or m.get("name") or "").lower()
+        for m in payload.get("models", [])
+        if isinstance(m, dict)
+    )
+
+def _cached_list(max_age: int = CACHE_MAX_AGE, use_cache: bool = True) -> Dict[str, Any]:
+    """ollama.list()の結果をTTL付きでキャッシュして返す
+    
+    Args:
+        max_age: キャッシュの有効期間（秒）
+        use_cache: Falseの場合は常にAPIへ問い合わせる
+    
+    Returns:
+        JSON化可能な辞書形式のモデル一覧
+    """
+    if use_cache:
+        try:
+            if time.time() - os.path.getmtime(CACHE_PATH) < max_age:
+                with open(CACHE_PATH, 'r', encoding='utf-8') as f:
+                    cached = json.load(f)
+                # Gemmaが無い一覧は「ollama pull」後の再実行で古くなっているかもしれないので使わない
+                if _has_gemma(cached):
+                    return cached
+        except (OSError, ValueError):
+            pass
+    
+    response = _clients()[0].list()
+    if hasattr(response, "model_dump"):
+        response = response.model_dump()
+    text = json.dumps(response, ensure_ascii=False, default=str)
+    
+    # 一時ファイルに書いてから置き換え（書き込み途中の読み込みを防ぐ）
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        tmp_path = CACHE_PATH + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, CACHE_PATH)
+    except OSError as e:
+        print(f"⚠️ キャッシュ保存失敗: {e}")
+    
+    return json.loads(text)
+
+def _http_get(path: str, timeout: float) -> Tuple[int, bytes]:
+    """Ollama APIへGETリクエストを送り、(ステータス, 本文) を返す"""
+    conn = http.client.HTTPConnection(OLLAMA_HOST, OLLAMA_PORT, timeout=timeout)
+    try:
+        conn.request("GET", path)
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+    finally:
+        conn.close()
+
+# サービス・接続確認結果の有効期間（秒）
+PROBE_CACHE_TTL = 30.0
+
+def _ttl_cache(ttl: float):
+    """引数なし関数の結果をttl秒間キャッシュするデコレータ"""
+    def decorator(func):
+        state: Dict[str, Any] = {}
+        
+        @functools.wraps(func)
+        def wrapper():
+            now = time.monotonic()
+            if "value" in state and now - state["time"] < ttl:
+                return state["value"]
+            state["value"] = func()
+            state["time"] = now
+            return state["value"]
+        
+        wrapper.cache_clear = state.clear
+        return wrapper
+    return decorator
+
+def _probe_cache_clear():
+    """サービス・接続確認のキャッシュを破棄（テスト用）"""
+    check_ollama_service.cache_clear()
+    check_ollama_connection.cache_clear()
 
+@_ttl_cache(PROBE_CACHE_TTL)
 def check_ollama_service() -> bool:
-    """Ollamaサービスの状態確認"""
+    """Ollamaサービスの状態確認
+    
+    デーモン自身の/api/versionに問い合わせる。systemd以外の起動方法
+    （ollama serve、Docker等）でも正しく判定できる。
+    """
     print("\n=== Ollamaサービス確認 ===")
     
     try:
-        result = subprocess.run(
-            ["systemctl", "is-active", "ollama"],
-            capture_output=True,
-            text=True
-        )
-        
-        if result.stdout.strip() == "active":
-            print("✅ Ollamaサービス: 稼働中")
+        status, body = _http_get("/api/version", timeout=1.5)
+        if status == 200:
+            version = json.loads(body).get("version", "不明")
+            print(f"✅ Ollamaサービス: 稼働中 (v{version})")
             return True
-        else:
-            print(f"⚠️ Ollamaサービス: {result.stdout.strip()}")
-            return False
-    except Exception as e:
-        print(f"⚠️ サービス確認失敗: {e}")
-        return False
+        print(f"⚠️ Ollamaサービス: ステータス {status}")
+    except (OSError, ValueError, http.client.HTTPException) as e:
+        print(f"⚠️ Ollamaサービス: 応答なし ({e})")
+    
+    # HTTPで応答がない場合のみsystemdの状態を参考表示
+    if sys.platform.startswith("linux") and shutil.which("systemctl"):
+        import subprocess
+        try:
+            result = subprocess.run(
+                ["systemctl", "is-active", "ollama"],
+                capture_output=True,
+                text=True
+            )
+            print(f"   systemctl: {result.stdout.strip()}")
+        except Exception as e:
+            print(f"⚠️ サービス確認失敗: {e}")
+    
+    return False
 
+@_ttl_cache(PROBE_CACHE_TTL)
 def check_ollama_connection() -> bool:
     """Ollama APIへの接続確認"""
     print("\n=== Ollama API接続確認 ===")
     
+    # curlを起動せず、プロセス内でHTTP接続して確認
     try:
-        # curlでの確認
-        result = subprocess.run(
-            ["curl", "-s", "http://localhost:11434"],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-        if "Ollama" in result.stdout or result.returncode == 0:
-            print("✅ API接続: http://localhost:11434")
-        else:
-            print("⚠️ API接続: 応答なし")
-    except:
-        print("⚠️ curlテスト失敗")
+        status, _ = _http_get("/", timeout=PROBE_READ_TIMEOUT)
+        if status == 200:
+            print(f"✅ API接続: http://{OLLAMA_HOST}:{OLLAMA_PORT}")
+            return True
+        print(f"⚠️ API接続: ステータス {status}")
+    except (OSError, http.client.HTTPException) as e:
+        print(f"⚠️ API接続: 応答なし ({e})")
     
-    return True
+    return False
 
-def check_models() -> Dict[str, Any]:
+def check_models(use_cache: bool = True) -> Dict[str, Any]:
     """モデルリストの確認"""
     print("\n=== モデル確認 ===")
     
     models_info = {
         "method": None,
         "models": [],
-        "raw_response": None
+        "raw_response": None,
+        "payload": None
     }
     
     # 方法1: ollama.list()を試す
     try:
-        response = ollama.list()
+        response = _cached_list(use_cache=use_cache)
         models_info["raw_response"] = str(type(response))
+        models_info["payload"] = response
         
         print(f"ollama.list()の返り値型: {type(response)}")
         
@@ -85,13 +221,14 @@ def check_models() -> Dict[str, Any]:
                 models_info["method"] = "dict with 'models' key"
                 for model in response['models']:
                     if isinstance(model, dict):
-                        name = model.get('name', 'unknown')
+                        name = model.get('name') or model.get('model', 'unknown')
                         models_info["models"].append(name)
                         print(f"  - {name}")
             # 直接モデル情報が入っている場合
             else:
                 models_info["method"] = "dict without 'models' key"
-                print(f"  内容: {json.dumps(response, indent=2, default=str)[:500]}")
+                preview = dict(itertools.islice(response.items(), 5))
+                print(f"  内容(先頭5キー): {preview!r}"[:500])
         
         elif isinstance(response, list):
             models_info["method"] = "list"
@@ -112,67 +249,119 @@ def check_models() -> Dict[str, Any]:
         print(f"❌ ollama.list()エラー: {e}")
         models_info["method"] = f"error: {e}"
     
-    # 方法2: CLIコマンドを試す
-    print("\n--- CLIでの確認 ---")
-    try:
-        result = subprocess.run(
-            ["ollama", "list"],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-        
-        if result.returncode == 0:
-            print("CLI出力:")
-            lines = result.stdout.strip().split('\n')
-            for line in lines[:10]:  # 最初の10行
-                print(f"  {line}")
-            
-            # モデル名を抽出（通常は2行目以降）
-            for line in lines[1:]:
-                parts = line.split()
-                if parts:
-                    model_name = parts[0]
-                    if model_name not in models_info["models"]:
-                        models_info["models"].append(f"[CLI] {model_name}")
-        else:
-            print(f"⚠️ CLIエラー: {result.stderr}")
+    # 方法2: APIでモデルが取得できなかった場合のみCLIコマンドを試す
+    if not models_info["models"]:
+        print("\n--- CLIでの確認 ---")
+        import subprocess
+        try:
+            # 出力を行単位で読み、届いた行から順に処理する
+            with subprocess.Popen(
+                ["ollama", "list"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            ) as proc:
+                # 応答しない場合でも読み込みが止まらないようにする
+                watchdog = threading.Timer(PROBE_READ_TIMEOUT, proc.kill)
+                watchdog.start()
+                try:
+                    seen = set(models_info["models"])
+                    line_count = 0
+                    for line in proc.stdout:
+                        line = line.rstrip('\n')
+                        if line_count == 0:
+                            print("CLI出力:")
+                        if line_count < 10:  # 表示は最初の10行だけ
+                            print(f"  {line}")
+                        
+                        # モデル名を抽出（通常は2行目以降。表示しない行も全て読む）
+                        if line_count > 0:
+                            model_name = line.strip().partition(' ')[0]
+                            if model_name and model_name not in seen:
+                                seen.add(model_name)
+                                models_info["models"].append(f"[CLI] {model_name}")
+                        
+                        line_count += 1
+                    
+                    returncode = proc.wait(timeout=PROBE_READ_TIMEOUT)
+                    if line_count == 0 and returncode != 0:
+                        print(f"⚠️ CLIエラー: {proc.stderr.read()}")
+                finally:
+                    watchdog.cancel()
             
-    except Exception as e:
-        print(f"⚠️ CLI確認失敗: {e}")
+        except Exception as e:
+            print(f"⚠️ CLI確認失敗: {e}")
     
+    models_info["gemma_models"] = [m for m in models_info["models"] if 'gemma' in m.lower()]
     return models_info
 
-def test_gemma3() -> bool:
-    """Gemma3モデルのテスト"""
+def _probe_model(model: str, deep: bool) -> str:
+    """単一モデルの確認。成功時は表示用メッセージを返し、失敗時は例外を送出"""
+    if deep:
+        response = _clients()[1].chat(
+            model=model,
+            messages=[
+                {"role": "user", "content": "Say 'OK' in one word"}
+            ],
+            options={
+                "num_predict": 5,
+                "temperature": 0.1
+            }
+        )
+        
+        if not (response and 'message' in response):
+            raise ValueError("応答形式が不正")
+        content = response['message'].get('content', '')
+        return f"動作確認OK\n   応答: {content[:50]}"
+    
+    # モデルをVRAMにロードせずメタデータのみ取得
+    show_resp = _clients()[0].show(model)
+    capabilities = show_resp.get("capabilities") or []
+    if capabilities:
+        return f"利用可能\n   機能: {', '.join(capabilities)}"
+    return "利用可能"
+
+def test_gemma3(deep: bool = False) -> bool:
+    """Gemma3モデルのテスト
+    
+    通常は/api/showのメタデータ取得のみで確認し、推論は行わない。
+    候補モデルは並列に確認し、最初に成功した時点で終了する。
+    deep=Trueの場合は実際にchatを実行して応答を確認する。複数のモデルを
+    同時にVRAMへロードしないよう、フォールバックの順に1つずつ試す。
+    """
     print("\n=== Gemma3動作テスト ===")
     
     models_to_test = ["gemma3:4b", "gemma3", "gemma2:2b"]  # フォールバック
+    print(f"テスト: {', '.join(models_to_test)}")
     
-    for model in models_to_test:
-        print(f"\nテスト: {model}")
-        try:
-            response = ollama.chat(
-                model=model,
-                messages=[
-                    {"role": "user", "content": "Say 'OK' in one word"}
-                ],
-                options={
-                    "num_predict": 5,
-                    "temperature": 0.1
-                }
-            )
+    if deep:
+        for model in models_to_test:
+            try:
+                message = _probe_model(model, deep)
+            except Exception as e:
+                print(f"❌ {model}: {str(e)[:100]}")
+                continue
+            print(f"✅ {model}: {message}")
+            return True
+        return False
+    
+    pool = ThreadPoolExecutor(max_workers=len(models_to_test))
+    try:
+        futures = {pool.submit(_probe_model, m, deep): m for m in models_to_test}
+        for fut in as_completed(futures):
+            model = futures[fut]
+            try:
+                message = fut.result()
+            except Exception as e:
+                print(f"❌ {model}: {str(e)[:100]}")
+                continue
             
-            if response and 'message' in response:
-                content = response['message'].get('content', '')
-                print(f"✅ {model}: 動作確認OK")
-                print(f"   応答: {content[:50]}")
-                return True
-            else:
-                print(f"⚠️ {model}: 応答形式が不正")
-                
-        except Exception as e:
-            print(f"❌ {model}: {str(e)[:100]}")
+            print(f"✅ {model}: {message}")
+            for other in futures:
+                other.cancel()
+            return True
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
     
     return False
 
@@ -185,7 +374,7 @@ def print_summary(models_info: Dict[str, Any], gemma_ok: bool):
     if models_info["models"]:
         print(f"✅ 検出されたモデル数: {len(models_info['models'])}")
         
-        gemma_models = [m for m in models_info["models"] if 'gemma' in m.lower()]
+        gemma_models = models_info.get("gemma_models", [])
         if gemma_models:
             print(f"✅ Gemmaモデル: {', '.join(gemma_models)}")
         else:
@@ -207,12 +396,85 @@ def print_summary(models_info: Dict[str, Any], gemma_ok: bool):
     print(f"  検出方法: {models_info['method']}")
     print(f"  応答型: {models_info['raw_response']}")
 
+def print_debug(models_info: Dict[str, Any]):
+    """取得済みのollama.list()結果をそのまま表示（--debug）"""
+    print("\n=== デバッグ情報 ===")
+    print(f"応答型: {models_info['raw_response']}")
+    print(json.dumps(models_info["payload"], ensure_ascii=False, indent=2, default=str)[:4000])
+
+class _StageOutput(threading.local):
+    """診断ステージごとの出力バッファ（スレッドローカル）"""
+    buffer = None
+
+_stage_output = _StageOutput()
+
+class _StdoutRouter:
+    """実行中のステージのバッファへ出力を振り分けるstdoutラッパー"""
+    
+    def __init__(self, stream):
+        self._stream = stream
+    
+    def write(self, text):
+        buffer = _stage_output.buffer
+        if buffer is not None:
+            return buffer.write(text)
+        return self._stream.write(text)
+    
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+def _run_captured(func, *args, **kwargs):
+    """関数を実行し、(戻り値, 出力テキスト) を返す"""
+    _stage_output.buffer = io.StringIO()
+    try:
+        result = func(*args, **kwargs)
+        return result, _stage_output.buffer.getvalue()
+    finally:
+        _stage_output.buffer = None
+
+async def run_checks(args) -> List[Any]:
+    """4つの診断ステージを並列に実行し、出力は元の順序で表示する"""
+    stages = [
+        (check_ollama_service, {}),
+        (check_ollama_connection, {}),
+        (check_models, {"use_cache": not args.no_cache}),
+        (test_gemma3, {"deep": args.deep}),
+    ]
+    
+    original_stdout = sys.stdout
+    sys.stdout = _StdoutRouter(original_stdout)
+    try:
+        outcomes = await asyncio.gather(*(
+            asyncio.to_thread(_run_captured, func, **kwargs)
+            for func, kwargs in stages
+        ))
+    finally:
+        sys.stdout = original_stdout
+    
+    results = []
+    for result, output in outcomes:
+        print(output, end="")
+        results.append(result)
+    return results
+
 def main():
+    parser = argparse.ArgumentParser(description="Ollama環境診断ツール")
+    parser.add_argument("--deep", action="store_true",
+                        help="メタデータ確認ではなく実際に推論してGemma3をテスト")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="モデル一覧のキャッシュを使わずに再取得")
+    parser.add_argument("--debug", action="store_true",
+                        help="ollama.list()の生の応答を表示")
+    args = parser.parse_args()
+    
     print("🔍 Ollama環境診断ツール")
     print("="*50)
     
-    # 1. サービス確認
-    service_ok = check_ollama_service()
+    if not import_ollama():
+        return 1
+    
+    # 1-4. サービス・接続・モデル・Gemma3の確認（並列実行）
+    service_ok, _, models_info, gemma_ok = asyncio.run(run_checks(args))
     
     if not service_ok:
         print("\n💡 Ollamaを起動してください:")
@@ -220,14 +482,8 @@ def main():
         print("   または")
         print("   ollama serve")
     
-    # 2. 接続確認
-    check_ollama_connection()
-    
-    # 3. モデル確認
-    models_info = check_models()
-    
-    # 4. Gemma3テスト
-    gemma_ok = test_gemma3()
+    if args.debug:
+        print_debug(models_info)
     
     # 5. サマリー
     print_summary(models_info, gemma_ok)
@@ -5,18 +5,29 @@ Gemma3 動的プロンプト生成版対話システム
 """
 
 import os
+import sys
 import json
+import hashlib
+import unicodedata
+from collections import Counter, deque
+import asyncio
 import random
 import re
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Callable, Tuple
 
-import ollama
+import httpx
 from colorama import init, Fore, Style
 from rich.console import Console
 from rich.panel import Panel
 from rich.progress import Progress, SpinnerColumn, TextColumn
 
+# orjson があれば高速なC実装を使い、なければ標準ライブラリにフォールバック
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 init(autoreset=True)
 console = Console()
 
@@ -27,14 +38,18 @@ GEMMA3_CONFIG = {
         "temperature": 0.7,
         "num_predict": 100,
         "top_p": 0.9,
-        "repeat_penalty": 1.1
+        "repeat_penalty": 1.1,
+        "num_ctx": 1024,  # 直近の履歴（HISTORY_WINDOW件）で十分（既定値よりKVキャッシュを小さく）
+        "num_batch": 512
     },
     "critic": {
         "model": "gemma3:4b", 
         "temperature": 0.6,
         "num_predict": 40,
         "top_p": 0.85,
-        "repeat_penalty": 1.2
+        "repeat_penalty": 1.2,
+        "num_ctx": 1024,
+        "num_batch": 512
     },
     "prompt_generator": {
         "model": "gemma3:12b",  # より賢いモデルでプロンプト生成
@@ -44,63 +59,496 @@ GEMMA3_CONFIG = {
     }
 }
 
-class DynamicPromptGenerator:
-    """テーマに応じた批評プロンプトの動的生成"""
+# 12Bが無くプロンプト生成も語り手・批評と同じ4Bを使う場合のロード設定
+# （ロード設定が食い違うとロールが替わるたびに読み込み直しになるため、全ロールで揃える。
+#   プロンプト生成の指示と出力は1024に収まらないので大きい方に合わせる）
+SHARED_4B_LOAD_OPTIONS = {"num_ctx": 2048, "num_batch": 512}
+
+# ===== Ollama非同期クライアント =====
+# 同じサーバーへの呼び出しは接続を共有し、同時リクエスト数はセマフォで制限する
+MAX_CONCURRENT_REQUESTS = 2
+# 対話中はモデルをVRAMに常駐させ、プレフィックスのKVキャッシュを保持する
+# （リクエストごとに期限が上書きされるため、ウォームアップと共通の値を使う）
+KEEP_ALIVE = "60m"
+
+def _normalize_host(host: str) -> str:
+    """ollamaクライアントと同じ書式（スキーム省略可）のホスト指定をURLにする"""
+    host = host.strip() or "localhost:11434"
+    if "://" not in host:
+        host = f"http://{host}"
+    return host.rstrip("/")
+
+# ロール別の接続先。未指定のロールは OLLAMA_HOST を使う
+# 例: 12Bのプロンプト生成だけ別GPUのサーバーで動かす
+#   OLLAMA_HOST_PROMPT_GENERATOR=http://gpu1:11434
+DEFAULT_HOST = _normalize_host(os.environ.get("OLLAMA_HOST", ""))
+ROLE_HOSTS = {
+    role: _normalize_host(os.environ.get(f"OLLAMA_HOST_{role.upper()}") or DEFAULT_HOST)
+    for role in GEMMA3_CONFIG
+}
+
+# 接続先ごとの (httpxクライアント, セマフォ)
+# chatはollamaクライアントを経由せず、接続を使い回すhttpxで直接APIを叩く
+# （応答ごとのモデルオブジェクト生成を省く。生成時間が読めないので読み取りは無制限）
+_BACKENDS: Dict[str, Tuple[httpx.AsyncClient, asyncio.Semaphore]] = {}
+
+def _backend(host: str) -> Tuple[httpx.AsyncClient, asyncio.Semaphore]:
+    """接続先ホストのクライアントとセマフォを返す（初回のみ作成）"""
+    if host not in _BACKENDS:
+        client = httpx.AsyncClient(
+            base_url=host,
+            timeout=httpx.Timeout(None, connect=5.0),
+            limits=httpx.Limits(max_keepalive_connections=4)
+        )
+        _BACKENDS[host] = (client, asyncio.Semaphore(MAX_CONCURRENT_REQUESTS))
+    return _BACKENDS[host]
+
+def _options(role: str) -> Dict[str, Any]:
+    """ロール設定からOllamaの生成オプションだけを取り出す"""
+    return {k: v for k, v in GEMMA3_CONFIG[role].items() if k != "model"}
+
+_ctx_warned = set()
+
+def _check_ctx_budget(model: str, messages: List[Dict[str, str]], options: Dict[str, Any]):
+    """プロンプトがnum_ctxに収まりそうか概算し、超えそうなら一度だけ警告する
     
-    def __init__(self):
-        self.model_config = GEMMA3_CONFIG["prompt_generator"]
-        self.cache = {}  # 生成済みプロンプトのキャッシュ
+    Gemma3のトークナイザでは日本語はおおむね1文字1トークン以下なので、
+    文字数を上限の目安として使う。溢れるとOllamaが先頭を切り詰め、
+    プレフィックスのKVキャッシュも効かなくなる。
+    """
+    num_ctx = options.get("num_ctx")
+    if not num_ctx or model in _ctx_warned:
+        return
+    estimated = sum(len(m["content"]) for m in messages)
+    if estimated + options.get("num_predict", 0) > num_ctx:
+        _ctx_warned.add(model)
+        console.print(f"[yellow]⚠️ プロンプトが num_ctx={num_ctx} を超える可能性があります（約{estimated}トークン）[/yellow]")
+
+async def chat_async(
+    role: str,
+    messages: List[Dict[str, str]],
+    stop_when: Optional[Callable[[str], bool]] = None,
+    num_predict: Optional[int] = None
+) -> str:
+    """ロールに割り当てたモデル・接続先へchatリクエストを送り、応答本文を返す
+    
+    Args:
+        role: GEMMA3_CONFIGのキー（narrator / critic / prompt_generator）
+        messages: チャット履歴
+        stop_when: 指定した場合はストリーミングで受信し、途中までの本文に対して
+            Trueを返した時点で接続を閉じてサーバー側の生成を打ち切る
+        num_predict: 指定した場合はロール設定の生成トークン数上限を上書きする
+    
+    Returns:
+        応答本文
+    """
+    model = GEMMA3_CONFIG[role]["model"]
+    options = _options(role)
+    if num_predict is not None:
+        options["num_predict"] = num_predict
+    _check_ctx_budget(model, messages, options)
+    payload = {
+        "model": model,
+        "messages": messages,
+        "options": options,
+        "keep_alive": KEEP_ALIVE,
+        "stream": stop_when is not None
+    }
+    
+    client, semaphore = _backend(ROLE_HOSTS[role])
+    async with semaphore:
+        if stop_when is None:
+            response = await client.post("/api/chat", json=payload)
+            response.raise_for_status()
+            return loads_json(response.text)['message']['content']
         
-    def extract_theme_elements(self, theme: str) -> Dict[str, str]:
-        """テーマから主要要素を抽出"""
-        prompt = f"""
-テーマ: {theme}
+        # 応答は1行1チャンクのJSON。途中で抜けると接続ごと閉じられ、生成も止まる
+        parts = []
+        async with client.stream("POST", "/api/chat", json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                chunk = loads_json(line)
+                parts.append(chunk['message']['content'])
+                if chunk.get('done') or stop_when("".join(parts)):
+                    break
+    return "".join(parts)
 
-このテーマから以下の要素を抽出してください。
-簡潔に答えてください。
+async def list_host_models(host: str) -> List[str]:
+    """接続先にインストールされているモデル名の一覧を /api/tags で取得する"""
+    client, _ = _backend(host)
+    response = await client.get("/api/tags")
+    response.raise_for_status()
+    return [
+        m.get("model") or m.get("name")
+        for m in loads_json(response.text).get("models", [])
+        if m.get("model") or m.get("name")
+    ]
 
-1. 舞台/場所:
-2. 時代/時間:
-3. 主要要素:
-4. ジャンル:
+async def warm_models(models: List[str], host: str = DEFAULT_HOST,
+                      options: Optional[Dict[str, Any]] = None) -> List[str]:
+    """モデルを事前にVRAMへロードし、KEEP_ALIVEの間常駐させる
+    
+    /api/ps で既に同じコンテキスト長でロード済みのモデルは飛ばし、残りは
+    空プロンプトのgenerateで並列にロードする。num_ctxなどのロード時の
+    オプションが本番のchatと違うとOllamaがロードし直すため、同じ値を渡す。
+    
+    Args:
+        models: ロードするモデル名のリスト
+        host: 接続先
+        options: ロード時のオプション（num_ctx / num_batch）
+    
+    Returns:
+        ロード済み（またはロードに成功した）モデルのリスト
+    """
+    options = options or {}
+    client, _ = _backend(host)
+    try:
+        response = await client.get("/api/ps")
+        running = loads_json(response.text)
+        loaded = {
+            m.get("model") or m.get("name"): m.get("context_length")
+            for m in running.get("models", [])
+        }
+    except Exception:
+        loaded = {}
+    
+    num_ctx = options.get("num_ctx")
+    pending = [
+        m for m in models
+        if m not in loaded or (num_ctx is not None and loaded[m] != num_ctx)
+    ]
+    payload = {"prompt": "", "keep_alive": KEEP_ALIVE}
+    if options:
+        payload["options"] = options
+    results = await asyncio.gather(
+        *(client.post("/api/generate", json={"model": m, **payload}) for m in pending),
+        return_exceptions=True
+    )
+    failed = {
+        m for m, r in zip(pending, results)
+        if isinstance(r, BaseException) or r.status_code >= 400
+    }
+    return [m for m in models if m not in failed]
 
-JSON形式で返答:
-{{"setting": "...", "time": "...", "element": "...", "genre": "..."}}
-"""
+# モデルのロード時に決まり、変えるとロードし直しになるオプション
+_LOAD_OPTIONS = ("num_ctx", "num_batch")
+
+def _load_options(role: str) -> Dict[str, Any]:
+    """ロール設定からロード時のオプションだけを取り出す"""
+    return {k: v for k, v in GEMMA3_CONFIG[role].items() if k in _LOAD_OPTIONS}
+
+async def warm_roles() -> Dict[str, List[str]]:
+    """全ロールのモデルを、それぞれの接続先とロード設定でまとめてウォームアップする
+    
+    同じ接続先の同じモデルを複数のロールが使う場合は、先に定義された
+    ロール（対話中に繰り返し呼ぶ語り手・批評）のロード設定でロードする。
+    
+    Returns:
+        接続先ごとのロード済み（またはロードに成功した）モデルのリスト
+    """
+    targets: Dict[Tuple[str, str], Tuple] = {}
+    for role, config in GEMMA3_CONFIG.items():
+        load_options = tuple(_load_options(role).items())
+        targets.setdefault((ROLE_HOSTS[role], config["model"]), load_options)
+    
+    groups: Dict[Tuple[str, Tuple], List[str]] = {}
+    for (host, model), load_options in targets.items():
+        groups.setdefault((host, load_options), []).append(model)
+    results = await asyncio.gather(*(
+        warm_models(sorted(models), host, dict(load_options))
+        for (host, load_options), models in groups.items()
+    ))
+    
+    loaded: Dict[str, List[str]] = {}
+    for (host, _), models in zip(groups, results):
+        loaded.setdefault(host, []).extend(models)
+    return loaded
+
+ROLE_LABELS = {"narrator": "語り", "critic": "批評"}
+
+# 応答クリーニング用の正規表現（モジュール読み込み時に一度だけコンパイル）
+_CLEAN_RE = re.compile(r'\[.*?\]|[「」]')  # 括弧・鉤括弧
+_FILLER_RE = re.compile(r'^(?:(?:はい|ええと|そうですね)、)+')  # 冒頭の「はい」「ええと」など
+_META_PHRASES = ("承知しました", "わかりました", "理解しました", "ご指摘", "修正", "確かに")  # 語り手のメタ発言
+_META_RE = re.compile('|'.join(_META_PHRASES))
+# ストリーミング途中で、続きを受信すると消える可能性のある末尾
+_OPEN_BRACKET_RE = re.compile(r'\[[^\]]*$')  # 閉じていない括弧
+_META_PREFIX_RE = re.compile('(?:' + '|'.join(
+    p[:i] for p in _META_PHRASES for i in range(1, len(p))
+) + ')$')  # メタ発言の書きかけ
+_SENT_SPLIT = re.compile(r'[。！？]')
+_DELIM_RE = re.compile(r'[。？！、]')  # 批評の切り詰め位置
+_CONTRA_RE = re.compile(r'ない|おかしい')  # 矛盾指摘（「ありえない」も「ない」で一致する）
+
+# プロンプトに含める直近の発言数（num_ctx=1024に収まる件数）
+HISTORY_WINDOW = 6
+
+# ストリーミング打ち切り条件（後段の切り詰めで捨てる分は生成させない）
+NARRATOR_MAX_SENTENCES = 2
+CRITIC_MAX_CHARS = 20
+
+# 批評のアクション別の生成トークン数上限（指示した文字数に少し余裕を持たせる）
+CRITIC_TOKEN_BUDGET = {
+    "listen": 12,          # 5文字以内
+    "question": 16,        # 10文字以内
+    "change_pattern": 16,  # 10文字以内
+    "analyze": 32,         # 15文字以内
+    "final_doubt": 32      # 15文字以内
+}
+
+def clean_text(text: str, role: str) -> str:
+    """応答のクリーニング（Gemma3特有のパターンに対応）"""
+    
+    # Gemma3が出力しやすい不要なパターンを削除
+    text = _FILLER_RE.sub('', _CLEAN_RE.sub('', text))
+    
+    # メタ発言の削除
+    if role == "narrator":
+        text = _META_RE.sub('', text)
+    
+    # 空白の正規化
+    text = ' '.join(text.split())
+    text = text.strip()
+    
+    return text
+
+def _limit_narrator(text: str) -> str:
+    """語り手: クリーニング済みの応答を2文までに切り詰める"""
+    sentences = _SENT_SPLIT.split(text)
+    sentences = [s for s in sentences if s.strip()]
+    if len(sentences) > NARRATOR_MAX_SENTENCES:
+        text = '。'.join(sentences[:NARRATOR_MAX_SENTENCES]) + '。'
+    return text
+
+def _limit_critic(text: str) -> str:
+    """批評: クリーニング済みの応答が長すぎれば最初の句読点で切る"""
+    if len(text) > CRITIC_MAX_CHARS:
+        m = _DELIM_RE.search(text)
+        text = text[:m.end()] if m else text[:CRITIC_MAX_CHARS]
+    return text
+
+# 打ち切り判定はクリーニング後の本文で行い、続きを受信しても
+# 切り詰め後の結果が変わらなくなった時点で止める
+# （メタ発言や冒頭の「はい、」は後で消えるので、生の本文では数えない）
+
+def _narrator_done(content: str) -> bool:
+    """語り手: 3文目が始まったら打ち切る"""
+    text = clean_text(content, "narrator")
+    if _OPEN_BRACKET_RE.search(text) or _META_PREFIX_RE.search(text):
+        return False
+    return _limit_narrator(text) != text
+
+def _critic_done(content: str) -> bool:
+    """批評: 文字数上限を超え、切り詰め位置の句読点が出たら打ち切る"""
+    text = clean_text(content, "critic")
+    if _OPEN_BRACKET_RE.search(text):
+        return False
+    return len(text) > CRITIC_MAX_CHARS and _DELIM_RE.search(text) is not None
+
+async def _cancel_task(task: asyncio.Task) -> None:
+    """タスクを取り消し、終了するまで待つ（完了済みなら結果・例外を回収するだけ）"""
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+def loads_json(text: str) -> Any:
+    """JSON文字列をデコードする（orjson優先）"""
+    if orjson is not None:
+        return orjson.loads(text.encode())
+    return json.loads(text)
+
+def dumps_json(data: Any) -> str:
+    """インデント付きでJSONにエンコードする（日本語はエスケープしない）"""
+    if orjson is not None:
+        return orjson.dumps(
+            data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+        ).decode()
+    return json.dumps(data, ensure_ascii=False, indent=2)
+
+def dumps_json_line(data: Any) -> bytes:
+    """JSONL用に1行分のJSON（改行付きバイト列）へエンコードする"""
+    if orjson is not None:
+        return orjson.dumps(data) + b"\n"
+    return (json.dumps(data, ensure_ascii=False) + "\n").encode()
+
+def extract_json(text: str) -> Optional[str]:
+    """テキスト中で最初に現れる、括弧の対応が取れた {...} を返す
+    
+    正規表現を使わず1回の走査で探す。文字列リテラル内の括弧と
+    エスケープされた引用符は無視する。
+    """
+    start = text.find("{")
+    if start == -1:
+        return None
+    
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+PROMPT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gemma3-dialogue", "prompts")
+PROMPT_CACHE_VERSION = 3  # キャッシュ内容の形式を変えたら上げる
+
+# ===== フォールバック用コンテキスト =====
+# リストはタプルにして共有定数が書き換えられないようにする
+_MARS_CTX = {
+    "facts": (
+        "火星には液体の水は存在しない",
+        "大気は薄く二酸化炭素が主成分",
+        "平均気温は-60度",
+        "重力は地球の38%",
+        "砂嵐が頻繁に発生する"
+    ),
+    "contradictions": (
+        "雨が降る",
+        "呼吸可能な大気",
+        "豊かな植生"
+    ),
+    "personality": "科学的",
+    "focus": ("物理法則", "技術的整合性"),
+    "forbidden": ("液体の水", "生物", "酸素")
+}
+
+_KONBINI_CTX = {
+    "facts": (
+        "24時間営業",
+        "狭い店内スペース",
+        "定番商品の品揃え",
+        "店員は1-2名",
+        "防犯カメラ設置"
+    ),
+    "contradictions": (
+        "巨大な売り場",
+        "珍しい商品",
+        "大人数の店員"
+    ),
+    "personality": "現実的",
+    "focus": ("日常性", "リアリティ"),
+    "forbidden": ("恐竜", "宇宙船", "魔法")
+}
+
+_GENERIC_CTX = {
+    "facts": (
+        "物理法則に従う",
+        "論理的整合性が必要",
+        "因果関係が明確",
+        "時系列が一貫",
+        "設定が統一"
+    ),
+    "contradictions": (
+        "前後の矛盾",
+        "設定の無視",
+        "論理破綻"
+    ),
+    "personality": "懐疑的",
+    "focus": ("一貫性", "論理性"),
+    "forbidden": ("矛盾", "非論理的展開")
+}
+
+# 批評コンテキストの項目と既定値
+CRITIC_CONTEXT_DEFAULTS = {
+    "facts": [],
+    "contradictions": [],
+    "personality": "懐疑的",
+    "focus": [],
+    "forbidden": []
+}
+
+def normalize_critic_context(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """モデルが生成した批評コンテキストを決まった形に揃える
+    
+    欠けた項目は既定値で補い、リスト項目は文字列のリストに統一する。
+    生成直後に一度だけ行い、以降は .get() や型チェックなしで参照できるようにする。
+    """
+    context = {}
+    for key, default in CRITIC_CONTEXT_DEFAULTS.items():
+        value = raw.get(key)
+        if isinstance(default, str):
+            context[key] = value if isinstance(value, str) and value else default
+        else:
+            if isinstance(value, str):
+                value = [value]
+            elif not isinstance(value, (list, tuple)):
+                value = default
+            context[key] = [str(v) for v in value]
+    return context
+
+# テーマに含まれるキーワード → コンテキスト（先に一致したものを使う）
+FALLBACK_CONTEXTS = {
+    "火星": _MARS_CTX,
+    "コンビニ": _KONBINI_CTX,
+}
+
+class DynamicPromptGenerator:
+    """テーマに応じた批評プロンプトの動的生成"""
+    
+    def __init__(self):
+        self.model_config = GEMMA3_CONFIG["prompt_generator"]
+        self.cache = {}  # 生成済みプロンプトのキャッシュ（プロセス内）
+    
+    def _cache_key(self, theme: str) -> str:
+        """テーマを正規化してディスクキャッシュのキーを作る
         
+        全角/半角・大文字/小文字・空白の揺れを吸収し、
+        生成モデルが変わった場合は別キーになるようにする。
+        """
+        canonical = " ".join(unicodedata.normalize("NFKC", theme).lower().split())
+        raw = f"{PROMPT_CACHE_VERSION}\n{self.model_config['model']}\n{canonical}".encode()
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
+    
+    def _load_cached(self, key: str) -> Optional[Dict[str, Any]]:
+        """ディスクキャッシュから生成済みコンテキストを読む"""
         try:
-            response = ollama.chat(
-                model=self.model_config["model"],
-                messages=[{"role": "user", "content": prompt}],
-                options={
-                    "temperature": 0.2,
-                    "num_predict": 200
-                }
-            )
-            
-            content = response['message']['content']
-            # JSON部分を抽出
-            json_match = re.search(r'\{[^}]+\}', content)
-            if json_match:
-                return json.loads(json_match.group())
-        except:
-            pass
-        
-        # フォールバック
-        return {
-            "setting": "不明",
-            "time": "現代",
-            "element": theme,
-            "genre": "フィクション"
-        }
+            with open(os.path.join(PROMPT_CACHE_DIR, f"{key}.json"), 'r', encoding='utf-8') as f:
+                return loads_json(f.read())
+        except (OSError, ValueError):
+            return None
     
-    def generate_critic_context(self, theme: str) -> Dict[str, Any]:
+    def _store_cached(self, key: str, context: Dict[str, Any]):
+        """生成済みコンテキストをディスクキャッシュに保存する"""
+        path = os.path.join(PROMPT_CACHE_DIR, f"{key}.json")
+        # 一時ファイルに書いてから置き換え（書き込み途中の読み込みを防ぐ）
+        try:
+            os.makedirs(PROMPT_CACHE_DIR, exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(dumps_json(context))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            console.print(f"[dim]⚠️ キャッシュ保存失敗: {e}[/dim]")
+        
+    async def generate_critic_context(self, theme: str) -> Dict[str, Any]:
         """批評用のコンテキストを生成"""
         
-        # キャッシュチェック
+        # キャッシュチェック（プロセス内 → ディスク）
         if theme in self.cache:
             console.print("[dim]💾 キャッシュからプロンプトを取得[/dim]")
-            return self.cache[theme]
+            return normalize_critic_context(self.cache[theme])
+        
+        key = self._cache_key(theme)
+        cached = self._load_cached(key)
+        if cached is not None:
+            console.print("[dim]💾 ディスクキャッシュからプロンプトを取得[/dim]")
+            self.cache[theme] = cached
+            return normalize_critic_context(cached)
         
         with Progress(
             SpinnerColumn(),
@@ -146,104 +594,52 @@ JSON形式で返答:
 """
             
             try:
-                response = ollama.chat(
-                    model=self.model_config["model"],
+                content = await chat_async(
+                    "prompt_generator",
                     messages=[
                         {"role": "system", "content": "あなたは物語の設定を分析する専門家です。"},
                         {"role": "user", "content": prompt}
-                    ],
-                    options=self.model_config
+                    ]
                 )
                 
-                content = response['message']['content']
-                
-                # JSONを抽出（```json``` ブロックも考慮）
-                content = re.sub(r'```json\n?', '', content)
-                content = re.sub(r'```\n?', '', content)
-                
-                # JSON部分を見つける
-                json_match = re.search(r'\{.*\}', content, re.DOTALL)
-                if json_match:
-                    result = json.loads(json_match.group())
-                    self.cache[theme] = result
-                    progress.stop_task(task)
-                    return result
+                # JSON部分を見つける（```json``` ブロックの囲みは読み飛ばされる）
+                json_text = extract_json(content)
+                if json_text:
+                    result = loads_json(json_text)
+                    if isinstance(result, dict):
+                        self.cache[theme] = result
+                        self._store_cached(key, result)
+                        progress.stop_task(task)
+                        return normalize_critic_context(result)
                     
             except Exception as e:
                 console.print(f"[red]⚠️ プロンプト生成エラー: {e}[/red]")
             
             progress.stop_task(task)
-            
+        
         # フォールバック
         return self._get_fallback_context(theme)
     
     def _get_fallback_context(self, theme: str) -> Dict[str, Any]:
         """フォールバック用の汎用コンテキスト"""
-        if "火星" in theme:
-            return {
-                "facts": [
-                    "火星には液体の水は存在しない",
-                    "大気は薄く二酸化炭素が主成分",
-                    "平均気温は-60度",
-                    "重力は地球の38%",
-                    "砂嵐が頻繁に発生する"
-                ],
-                "contradictions": [
-                    "雨が降る",
-                    "呼吸可能な大気",
-                    "豊かな植生"
-                ],
-                "personality": "科学的",
-                "focus": ["物理法則", "技術的整合性"],
-                "forbidden": ["液体の水", "生物", "酸素"]
-            }
-        elif "コンビニ" in theme:
-            return {
-                "facts": [
-                    "24時間営業",
-                    "狭い店内スペース",
-                    "定番商品の品揃え",
-                    "店員は1-2名",
-                    "防犯カメラ設置"
-                ],
-                "contradictions": [
-                    "巨大な売り場",
-                    "珍しい商品",
-                    "大人数の店員"
-                ],
-                "personality": "現実的",
-                "focus": ["日常性", "リアリティ"],
-                "forbidden": ["恐竜", "宇宙船", "魔法"]
-            }
-        else:
-            return {
-                "facts": [
-                    "物理法則に従う",
-                    "論理的整合性が必要",
-                    "因果関係が明確",
-                    "時系列が一貫",
-                    "設定が統一"
-                ],
-                "contradictions": [
-                    "前後の矛盾",
-                    "設定の無視",
-                    "論理破綻"
-                ],
-                "personality": "懐疑的",
-                "focus": ["一貫性", "論理性"],
-                "forbidden": ["矛盾", "非論理的展開"]
-            }
+        context = next(
+            (ctx for keyword, ctx in FALLBACK_CONTEXTS.items() if keyword in theme),
+            _GENERIC_CTX
+        )
+        # 呼び出し側で書き換えられても定数に影響しないよう浅いコピーを返す
+        return dict(context)
     
     def create_critic_prompt(self, context: Dict[str, Any]) -> str:
         """批評AI用のシステムプロンプトを構築"""
         
-        facts = "\n".join([f"・{fact}" for fact in context.get("facts", [])])
-        forbidden = ", ".join(context.get("forbidden", []))
+        facts = "\n".join([f"・{fact}" for fact in context["facts"]])
+        forbidden = ", ".join(context["forbidden"])
+        example = context["forbidden"][0] if context["forbidden"] else "矛盾"
         
         # Gemma3に最適化されたプロンプト
         return f"""
 ### 役割
-あなたは{context.get('personality', '懐疑的')}な批評家です。
+あなたは{context['personality']}な批評家です。
 
 ### ルール
 1. 返答は必ず15文字以内
@@ -258,7 +654,7 @@ JSON形式で返答:
 {forbidden}
 
 ### 指摘の例
-- 「{forbidden.split(',')[0] if forbidden else '矛盾'}はない」
+- 「{example}はない」
 - 「それはおかしい」
 - 「ありえない」
 """
@@ -270,11 +666,12 @@ class SmartDirector:
         self.contradiction_count = 0
         self.last_contradiction_turn = -1
         self.story_momentum = 0
-        self.critic_patterns = []
+        # 直近3回分だけを保持（古いものは自動的に捨てられる）
+        self.critic_patterns = deque(maxlen=3)
         
     def analyze_critic_response(self, text: str) -> str:
         """批評のパターンを分析"""
-        if "ない" in text or "おかしい" in text or "ありえない" in text:
+        if _CONTRA_RE.search(text):
             return "contradiction"
         elif "？" in text:
             return "question"
@@ -296,14 +693,13 @@ class SmartDirector:
                 self.last_contradiction_turn = turn
         
         # 同じパターンが3回続いたら変更を促す
-        if len(self.critic_patterns) >= 3:
-            recent = self.critic_patterns[-3:]
-            if len(set(recent)) == 1:  # 全部同じ
-                return {
-                    "to": "critic",
-                    "action": "change_pattern",
-                    "note": "パターンを変える"
-                }
+        recent = self.critic_patterns
+        if len(recent) == 3 and recent[0] == recent[1] == recent[2]:  # 全部同じ
+            return {
+                "to": "critic",
+                "action": "change_pattern",
+                "note": "パターンを変える"
+            }
         
         # 矛盾が多すぎる場合
         if self.contradiction_count > 2 and turn - self.last_contradiction_turn < 2:
@@ -356,70 +752,85 @@ class SmartDirector:
 class DynamicDialogueSystem:
     """動的プロンプト生成による対話システム"""
     
-    def __init__(self, theme: str):
+    def __init__(self, theme: str, context: Dict[str, Any], critic_prompt: str,
+                 log_path: Optional[str] = None):
         self.theme = theme
         self.dialogue = []
+        # 発話ごとに1行追記するJSONLログ（途中で落ちても記録が残る）
+        self._log_fh = open(log_path, "ab") if log_path else None
         self.director = SmartDirector()
         self.turn = 0
         
-        # プロンプト生成
-        generator = DynamicPromptGenerator()
-        self.context = generator.generate_critic_context(theme)
-        self.critic_prompt = generator.create_critic_prompt(self.context)
+        self.context = context
+        self.critic_prompt = critic_prompt
+        # 批評の指示で毎ターン使うため、禁止要素の連結とアクション別指示の構築は一度だけ行う
+        self._forbidden_joined = ", ".join(context.get("forbidden", []))
+        self._action_prompts = {
+            "listen": "相槌を打ってください。5文字以内。（例：へー、ふーん、それで？）",
+            "question": "短い質問をしてください。10文字以内。（例：どこで？なぜ？）",
+            "analyze": f"矛盾があれば指摘、なければ感想。15文字以内。禁止要素: {self._forbidden_joined}",
+            "change_pattern": "いつもと違う反応をしてください。10文字以内。",
+            "final_doubt": "最後の疑問や感想。15文字以内。"
+        }
+        # 語り手のシステムプロンプトは対話中不変（プレフィックスキャッシュを効かせるため）
+        self.narrator_system = f"あなたは「{self.theme}」の物語を語る語り手です。簡潔に、具体的に。"
         
         # デバッグ表示
         self._show_context()
     
+    @classmethod
+    async def create(cls, theme: str, log_path: Optional[str] = None) -> "DynamicDialogueSystem":
+        """批評プロンプトを生成してからインスタンスを構築"""
+        generator = DynamicPromptGenerator()
+        context = await generator.generate_critic_context(theme)
+        return cls(theme, context, generator.create_critic_prompt(context), log_path)
+    
+    def _record(self, entry: Dict[str, Any]):
+        """発話を履歴に追加し、ログファイルにも追記する"""
+        self.dialogue.append(entry)
+        if self._log_fh:
+            self._log_fh.write(dumps_json_line(entry))
+            self._log_fh.flush()
+    
+    def close(self):
+        """ログファイルを閉じる"""
+        if self._log_fh:
+            self._log_fh.close()
+            self._log_fh = None
+    
+    def _build_user_prompt(self, instruction: str) -> str:
+        """固定ヘッダ + 直近の対話 + 今回の指示 の順でユーザーメッセージを構築
+        
+        履歴がHISTORY_WINDOW件に達するまでは末尾に追記されるだけなので、
+        毎ターン変わるのは指示部分のみになり、Ollama側でそれ以前の
+        プレフィックスのKVキャッシュが再利用される。それ以降は古い発言を
+        落として、num_ctxを超えてシステムプロンプトが切り詰められないようにする。
+        """
+        history = "\n".join(
+            f"{ROLE_LABELS[e['role']]}: {e['content']}" for e in self.dialogue[-HISTORY_WINDOW:]
+        )
+        return f"### これまでの物語\n{history}\n\n### 指示\n{instruction.strip()}"
+    
     def _show_context(self):
         """生成されたコンテキストを表示"""
         console.print("\n[bold cyan]📋 生成された批評設定[/bold cyan]")
         console.print(f"性格: {self.context.get('personality', '不明')}")
         console.print(f"重要事実: {len(self.context.get('facts', []))}個")
-        console.print(f"禁止要素: {', '.join(self.context.get('forbidden', []))}")
+        console.print(f"禁止要素: {self._forbidden_joined}")
         console.print()
     
     def clean_response(self, text: str, role: str) -> str:
         """応答のクリーニング（Gemma3特有のパターンに対応）"""
-        
-        # Gemma3が出力しやすい不要なパターンを削除
-        patterns_to_remove = [
-            r'\[.*?\]',  # 括弧
-            r'「|」',    # 鉤括弧
-            r'^はい、',  # 冒頭の「はい」
-            r'^ええと、', # 冒頭の「ええと」
-            r'^そうですね、', # 冒頭の「そうですね」
-        ]
-        
-        for pattern in patterns_to_remove:
-            text = re.sub(pattern, '', text)
-        
-        # メタ発言の削除
-        if role == "narrator":
-            meta_phrases = [
-                "承知しました",
-                "わかりました",
-                "理解しました",
-                "ご指摘",
-                "修正",
-                "確かに"
-            ]
-            for phrase in meta_phrases:
-                text = text.replace(phrase, "")
-        
-        # 空白の正規化
-        text = ' '.join(text.split())
-        text = text.strip()
-        
-        return text
+        return clean_text(text, role)
     
-    def get_narrator_response(self, critic_text: str = "", action: str = "continue") -> str:
+    async def get_narrator_response(self, critic_text: str = "", action: str = "continue") -> str:
         """語り手の応答（Gemma3最適化）"""
         
         # アクションに応じたプロンプト生成
         if self.turn == 0:
             prompt = f"「{self.theme}」の物語を始めてください。具体的な場面から2文で。"
         
-        elif "ない" in critic_text or "おかしい" in critic_text:
+        elif _CONTRA_RE.search(critic_text):
             # 矛盾指摘への対応
             prompt = f"""
 批評: {critic_text}
@@ -437,6 +848,10 @@ class DynamicDialogueSystem:
         elif action == "climax":
             prompt = f"物語をクライマックスに導いてください。重要な発見や転機を2文で。"
         
+        elif action == "resume":
+            # 相槌の後の継続（批評の内容に依存しないので先行して生成できる）
+            prompt = "物語を続けてください。2文で。"
+        
         else:
             prompt = f"""
 批評: {critic_text}
@@ -446,68 +861,42 @@ class DynamicDialogueSystem:
         
         # Gemma3用の構造化
         messages = [
-            {"role": "system", "content": f"あなたは「{self.theme}」の物語を語る語り手です。簡潔に、具体的に。"},
-            {"role": "user", "content": prompt}
+            {"role": "system", "content": self.narrator_system},
+            {"role": "user", "content": self._build_user_prompt(prompt)}
         ]
         
-        response = ollama.chat(
-            model=GEMMA3_CONFIG["narrator"]["model"],
+        content = await chat_async(
+            "narrator",
             messages=messages,
-            options=GEMMA3_CONFIG["narrator"]
+            stop_when=_narrator_done
         )
         
-        text = self.clean_response(response['message']['content'], "narrator")
-        
         # 2文制限
-        sentences = re.split(r'[。！？]', text)
-        sentences = [s for s in sentences if s.strip()]
-        if len(sentences) > 2:
-            text = '。'.join(sentences[:2]) + '。'
-        
-        return text
+        return _limit_narrator(self.clean_response(content, "narrator"))
     
-    def get_critic_response(self, narrator_text: str, action: str = "listen") -> str:
+    async def get_critic_response(self, narrator_text: str, action: str = "listen") -> str:
         """批評の応答（Gemma3最適化）"""
         
-        # アクション別プロンプト
-        action_prompts = {
-            "listen": "相槌を打ってください。5文字以内。（例：へー、ふーん、それで？）",
-            "question": "短い質問をしてください。10文字以内。（例：どこで？なぜ？）",
-            "analyze": f"矛盾があれば指摘、なければ感想。15文字以内。禁止要素: {', '.join(self.context.get('forbidden', []))}",
-            "change_pattern": "いつもと違う反応をしてください。10文字以内。",
-            "final_doubt": "最後の疑問や感想。15文字以内。"
-        }
-        
         prompt = f"""
 語り手: {narrator_text}
 
-{action_prompts.get(action, '反応してください。10文字以内。')}
+{self._action_prompts.get(action, '反応してください。10文字以内。')}
 """
         
-        response = ollama.chat(
-            model=GEMMA3_CONFIG["critic"]["model"],
+        content = await chat_async(
+            "critic",
             messages=[
                 {"role": "system", "content": self.critic_prompt},
-                {"role": "user", "content": prompt}
+                {"role": "user", "content": self._build_user_prompt(prompt)}
             ],
-            options=GEMMA3_CONFIG["critic"]
+            stop_when=_critic_done,
+            num_predict=CRITIC_TOKEN_BUDGET.get(action, GEMMA3_CONFIG["critic"]["num_predict"])
         )
         
-        text = self.clean_response(response['message']['content'], "critic")
-        
         # 長さ制限
-        if len(text) > 20:
-            # 句読点で切る
-            for delimiter in ['。', '？', '！', '、']:
-                if delimiter in text:
-                    text = text.split(delimiter)[0] + delimiter
-                    break
-            else:
-                text = text[:20]
-        
-        return text
+        return _limit_critic(self.clean_response(content, "critic"))
     
-    def run_dialogue(self, max_turns: int = 10):
+    async def run_dialogue(self, max_turns: int = 10):
         """対話の実行"""
         
         console.print(Panel(f"[bold cyan]🎬 {self.theme}[/bold cyan]", expand=False))
@@ -524,12 +913,12 @@ class DynamicDialogueSystem:
             
             # 語り手のターン
             if turn == 0 or instruction["to"] == "narrator":
-                narrator_text = self.get_narrator_response(
+                narrator_text = await self.get_narrator_response(
                     critic_text,
                     instruction.get("action", "continue")
                 )
                 print(f"{Fore.MAGENTA}語り:{Style.RESET_ALL} {narrator_text}")
-                self.dialogue.append({
+                self._record({
                     "role": "narrator",
                     "content": narrator_text,
                     "turn": turn
@@ -538,34 +927,52 @@ class DynamicDialogueSystem:
             
             # 批評のターン
             if turn < max_turns - 1 and (turn == 0 or instruction["to"] == "critic"):
-                critic_text = self.get_critic_response(
-                    narrator_text,
-                    instruction.get("action", "listen")
-                )
-                
-                # パターン分析
-                pattern = self.director.analyze_critic_response(critic_text)
-                if pattern == "contradiction":
-                    console.print(f"[yellow]⚠️ 矛盾指摘: {critic_text}[/yellow]")
+                action = instruction.get("action", "listen")
+                continue_after = instruction["to"] == "critic" and turn < max_turns - 2
+                critic_task = asyncio.create_task(self.get_critic_response(narrator_text, action))
                 
-                print(f"{Fore.CYAN}批評:{Style.RESET_ALL} {critic_text}")
-                self.dialogue.append({
-                    "role": "critic",
-                    "content": critic_text,
-                    "turn": turn,
-                    "pattern": pattern
-                })
+                # 相槌の内容は語りの続きに影響しないので、批評と並行して投機的に生成しておく
+                speculative = None
+                if continue_after and action == "listen":
+                    speculative = asyncio.create_task(self.get_narrator_response(action="resume"))
                 
-                # 批評後の語り手継続
-                if instruction["to"] == "critic" and turn < max_turns - 2:
-                    narrator_text = self.get_narrator_response(critic_text)
-                    print(f"{Fore.MAGENTA}語り:{Style.RESET_ALL} {narrator_text}")
-                    self.dialogue.append({
-                        "role": "narrator",
-                        "content": narrator_text,
-                        "turn": turn
+                try:
+                    critic_text = await critic_task
+                    
+                    # パターン分析
+                    pattern = self.director.analyze_critic_response(critic_text)
+                    if pattern == "contradiction":
+                        console.print(f"[yellow]⚠️ 矛盾指摘: {critic_text}[/yellow]")
+                    
+                    print(f"{Fore.CYAN}批評:{Style.RESET_ALL} {critic_text}")
+                    self._record({
+                        "role": "critic",
+                        "content": critic_text,
+                        "turn": turn,
+                        "pattern": pattern
                     })
-                    self.director.story_momentum += 1
+                    
+                    # 批評後の語り手継続（矛盾指摘なら投機結果を捨てて応答し直す）
+                    if continue_after:
+                        if speculative and pattern != "contradiction":
+                            narrator_text = await speculative
+                        else:
+                            if speculative:
+                                # ストリームを閉じてから次のリクエストに枠を渡す
+                                await _cancel_task(speculative)
+                            narrator_text = await self.get_narrator_response(critic_text)
+                        print(f"{Fore.MAGENTA}語り:{Style.RESET_ALL} {narrator_text}")
+                        self._record({
+                            "role": "narrator",
+                            "content": narrator_text,
+                            "turn": turn
+                        })
+                        self.director.story_momentum += 1
+                
+                finally:
+                    # 批評の失敗などで抜けた場合も、投機生成を放置せず止めておく
+                    if speculative is not None:
+                        await _cancel_task(speculative)
             
             print("-" * 40)
         
@@ -583,125 +990,103 @@ class DynamicDialogueSystem:
             }
         }
         
-        # パターン集計
+        # パターン集計と文字数集計を1回の走査で行う
+        patterns = Counter()
+        n_sum = n_cnt = c_sum = c_cnt = 0
         for entry in self.dialogue:
-            if entry["role"] == "critic" and "pattern" in entry:
-                pattern = entry["pattern"]
-                analysis["patterns"][pattern] = analysis["patterns"].get(pattern, 0) + 1
+            if entry["role"] == "narrator":
+                n_sum += len(entry["content"])
+                n_cnt += 1
+            elif entry["role"] == "critic":
+                c_sum += len(entry["content"])
+                c_cnt += 1
+                if "pattern" in entry:
+                    patterns[entry["pattern"]] += 1
         
-        # 平均文字数
-        narrator_lengths = [len(e["content"]) for e in self.dialogue if e["role"] == "narrator"]
-        critic_lengths = [len(e["content"]) for e in self.dialogue if e["role"] == "critic"]
+        analysis["patterns"] = dict(patterns)
         
-        if narrator_lengths:
-            analysis["avg_length"]["narrator"] = sum(narrator_lengths) / len(narrator_lengths)
-        if critic_lengths:
-            analysis["avg_length"]["critic"] = sum(critic_lengths) / len(critic_lengths)
+        # 平均文字数
+        if n_cnt:
+            analysis["avg_length"]["narrator"] = n_sum / n_cnt
+        if c_cnt:
+            analysis["avg_length"]["critic"] = c_sum / c_cnt
         
         return analysis
 
-def main():
+async def main():
     console.print("[bold green]🎭 Gemma3 動的プロンプト生成版[/bold green]")
     console.print("[dim]A5000 + Ubuntu 24.04 最適化版[/dim]\n")
     
     # Ollama確認
     try:
-        # まずは単純な接続テスト
-        try:
-            models_response = ollama.list()
-            console.print("[dim]Ollama応答確認...[/dim]")
-        except Exception as conn_error:
-            console.print(f"[red]❌ Ollama接続失敗: {conn_error}[/red]")
+        # ロールごとの接続先それぞれにモデル一覧を問い合わせる
+        hosts = sorted(set(ROLE_HOSTS.values()))
+        listed = await asyncio.gather(*(list_host_models(h) for h in hosts), return_exceptions=True)
+        unreachable = [h for h, r in zip(hosts, listed) if isinstance(r, BaseException)]
+        if unreachable:
+            for host, result in zip(hosts, listed):
+                if isinstance(result, BaseException):
+                    console.print(f"[red]❌ Ollama接続失敗 ({host}): {result}[/red]")
             console.print("\n[yellow]対処法:[/yellow]")
             console.print("  1. Ollamaが起動しているか確認:")
             console.print("     sudo systemctl status ollama")
             console.print("  2. Ollamaを起動:")
             console.print("     sudo systemctl start ollama")
             console.print("  3. ポート確認:")
-            console.print("     curl http://localhost:11434")
+            console.print(f"     curl {unreachable[0]}")
             return 1
+        console.print("[dim]Ollama応答確認...[/dim]")
+        models_by_host = dict(zip(hosts, listed))
         
-        # モデルリストの構造を確認
-        available_models = []
-        
-        # ollama._types.ListResponse型に対応
-        if hasattr(models_response, 'models'):
-            # ListResponse型の場合（現在のollama）
-            for model in models_response.models:
-                if hasattr(model, 'model'):
-                    # Modelオブジェクトのmodel属性から名前を取得
-                    available_models.append(model.model)
-                elif isinstance(model, dict) and 'name' in model:
-                    available_models.append(model['name'])
-                elif isinstance(model, str):
-                    available_models.append(model)
-        elif isinstance(models_response, dict):
-            # 辞書形式の場合（旧バージョン）
-            if 'models' in models_response:
-                for model in models_response['models']:
-                    if isinstance(model, dict) and 'name' in model:
-                        available_models.append(model['name'])
-                    elif isinstance(model, str):
-                        available_models.append(model)
-        elif isinstance(models_response, list):
-            # リスト形式の場合
-            for model in models_response:
-                if isinstance(model, dict) and 'name' in model:
-                    available_models.append(model['name'])
-                elif isinstance(model, str):
-                    available_models.append(model)
-        
-        if not available_models:
-            # モデルリストが取得できない場合、直接動作確認
+        if not all(models_by_host.values()):
+            # モデルリストが取得できない場合、ロードできるかで判断する
             console.print("[yellow]⚠️ モデルリストの取得に失敗。動作確認を試みます...[/yellow]")
-            try:
-                test = ollama.chat(
-                    model='gemma3:4b',
-                    messages=[{'role': 'user', 'content': 'test'}],
-                    options={'num_predict': 1}
-                )
-                console.print("[green]✅ Gemma3:4b 動作確認OK[/green]")
-                available_models = ['gemma3:4b']
-                
-                # 12Bも試す
-                try:
-                    test = ollama.chat(
-                        model='gemma3:12b',
-                        messages=[{'role': 'user', 'content': 'test'}],
-                        options={'num_predict': 1}
-                    )
-                    available_models.append('gemma3:12b')
-                except:
-                    pass
-            except:
-                console.print("[red]❌ Gemma3:4b が動作しません[/red]")
-                console.print("以下を実行してください:")
-                console.print("  ollama pull gemma3:4b")
-                return 1
+            for host, loaded in (await warm_roles()).items():
+                if not models_by_host[host]:
+                    models_by_host[host] = loaded
+        
+        def has_model(role: str, model: str) -> bool:
+            return any(model in m for m in models_by_host[ROLE_HOSTS[role]])
         
         # モデル情報の表示
         console.print(f"[green]✅ Ollama接続OK[/green]")
-        console.print(f"[dim]検出されたモデル: {', '.join(available_models[:3])}{'...' if len(available_models) > 3 else ''}[/dim]")
-        
-        # 必要なモデルのチェック
-        has_4b = any("gemma3:4b" in m for m in available_models)
-        has_12b = any("gemma3:12b" in m for m in available_models)
+        for host, available_models in models_by_host.items():
+            console.print(f"[dim]検出されたモデル ({host}): {', '.join(available_models[:3])}{'...' if len(available_models) > 3 else ''}[/dim]")
         
-        if not has_4b:
-            console.print("[red]❌ Gemma3:4b が見つかりません[/red]")
-            console.print("以下を実行してください:")
-            console.print("  ollama pull gemma3:4b")
-            return 1
+        # 必要なモデルのチェック（各ロールの接続先で確認する）
+        for role in ("narrator", "critic"):
+            model = GEMMA3_CONFIG[role]["model"]
+            if not has_model(role, model):
+                console.print(f"[red]❌ {model} が {ROLE_HOSTS[role]} に見つかりません（{ROLE_LABELS[role]}）[/red]")
+                console.print("以下を実行してください:")
+                console.print(f"  OLLAMA_HOST={ROLE_HOSTS[role]} ollama pull {model}")
+                return 1
         
-        if not has_12b:
+        if not has_model("prompt_generator", "gemma3:12b"):
             console.print("[yellow]⚠️ Gemma3:12b が見つかりません（オプション）[/yellow]")
+            if not has_model("prompt_generator", "gemma3:4b"):
+                console.print(f"[red]❌ Gemma3:4b も {ROLE_HOSTS['prompt_generator']} に見つかりません[/red]")
+                console.print("以下を実行してください:")
+                console.print(f"  OLLAMA_HOST={ROLE_HOSTS['prompt_generator']} ollama pull gemma3:4b")
+                return 1
             console.print("[dim]プロンプト生成に4Bモデルを使用します[/dim]")
             GEMMA3_CONFIG["prompt_generator"]["model"] = "gemma3:4b"
+            shared = [
+                role for role in ("narrator", "critic")
+                if ROLE_HOSTS[role] == ROLE_HOSTS["prompt_generator"]
+                and GEMMA3_CONFIG[role]["model"] == "gemma3:4b"
+            ]
+            if shared:
+                for role in (*shared, "prompt_generator"):
+                    GEMMA3_CONFIG[role].update(SHARED_4B_LOAD_OPTIONS)
         else:
             console.print("[dim]12Bモデルでプロンプト生成を行います[/dim]")
         
         console.print()
         
+        # テーマ選択の間にモデルをロードしておく
+        warmup = asyncio.create_task(warm_roles())
+        
     except Exception as e:
         console.print(f"[red]❌ 予期しないエラー: {e}[/red]")
         console.print("\n[yellow]デバッグ手順:[/yellow]")
@@ -728,11 +1113,11 @@ def main():
         console.print(f"  {i}. {theme}")
     
     try:
-        choice = input("\n選択 (1-8): ").strip()
+        choice = (await asyncio.to_thread(input, "\n選択 (1-8): ")).strip()
         idx = int(choice) - 1
         
         if idx == 7:  # カスタム
-            selected_theme = input("テーマを入力: ").strip()
+            selected_theme = (await asyncio.to_thread(input, "テーマを入力: ")).strip()
             if not selected_theme:
                 selected_theme = themes[0]
         else:
@@ -744,9 +1129,17 @@ def main():
     
     console.print(f"\n[bold cyan]選択されたテーマ: {selected_theme}[/bold cyan]\n")
     
-    # 実行
-    system = DynamicDialogueSystem(selected_theme)
-    dialogue = system.run_dialogue(max_turns=8)
+    # 実行（対話ログは発話ごとに追記保存）
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    os.makedirs("outputs", exist_ok=True)
+    log_file = f"outputs/dynamic_{timestamp}.jsonl"
+    
+    await warmup
+    system = await DynamicDialogueSystem.create(selected_theme, log_path=log_file)
+    try:
+        await system.run_dialogue(max_turns=8)
+    finally:
+        system.close()
     
     # 分析結果表示
     analysis = system.analyze_dialogue()
@@ -759,23 +1152,21 @@ def main():
     console.print(f"  語り手: {analysis['avg_length']['narrator']:.1f}文字")
     console.print(f"  批評者: {analysis['avg_length']['critic']:.1f}文字")
     
-    # 保存
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    os.makedirs("outputs", exist_ok=True)
-    filename = f"outputs/dynamic_{timestamp}.json"
+    # 保存（対話本体はJSONLに記録済みなので、メタ情報のみ書き出す）
+    filename = f"outputs/dynamic_{timestamp}.meta.json"
     
     save_data = {
         "theme": selected_theme,
         "context": system.context,
-        "dialogue": dialogue,
+        "dialogue_log": os.path.basename(log_file),
         "analysis": analysis,
         "timestamp": timestamp
     }
     
     with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(save_data, f, ensure_ascii=False, indent=2)
+        f.write(dumps_json(save_data))
     
-    console.print(f"\n[green]✅ 保存完了: {filename}[/green]")
+    console.print(f"\n[green]✅ 保存完了: {log_file}, {filename}[/green]")
     
     # パフォーマンス情報
     console.print("\n[dim]━━━ Performance Info ━━━[/dim]")
@@ -785,5 +1176,4 @@ def main():
     return 0
 
 if __name__ == "__main__":
-    import sys
-    sys.exit(main())
\ No newline at end of file
+    sys.exit(asyncio.run(main()))
\ No newline at end of file
@@ -3,15 +3,79 @@
 対話システムのコンポーネント群（改良版）
 """
 
-import json
+import os
 import re
+import json
+import hashlib
+import functools
+import threading
 from typing import Dict, List, Any
 
 import ollama
 from rich.console import Console
 
+from utils import load_json, save_json, json_bytes, ensure_dir, list_models
+
 console = Console()
 
+# 応答中の最初のJSONオブジェクトだけを読み取るデコーダ
+_JSON_DECODER = json.JSONDecoder()
+
+# 批評の感嘆表現
+_EXCLAMATION_RE = re.compile(r'！|おお|すごい')
+
+# 動的生成したコンテキストを実行をまたいで再利用するためのファイル
+PROMPT_CACHE_PATH = os.path.join("outputs", ".prompt_cache.json")
+# 複数スレッドから同時に書き出さないためのロック
+_DISK_CACHE_LOCK = threading.Lock()
+
+
+def classify_critic(text: str) -> str:
+    """批評のパターンを判定（状態を持たない）
+    
+    Args:
+        text: 批評のテキスト
+    
+    Returns:
+        パターンの種類（contradiction/question/backchannel/exclamation/comment）
+    """
+    # より柔軟なパターン認識
+    # （「じゃない？」「違わない？」も「ない？」に含まれる）
+    if "ない？" in text:
+        return "contradiction"
+    elif "？" in text:
+        return "question"
+    elif len(text) <= 5:
+        return "backchannel"  # 相槌
+    elif _EXCLAMATION_RE.search(text):
+        return "exclamation"  # 感嘆
+    else:
+        return "comment"
+
+
+@functools.lru_cache(maxsize=32)
+def _resolve_model(primary: str, fallback: str) -> str:
+    """利用するモデルを決定（モデル一覧は起動時の確認と共有する）
+    
+    Args:
+        primary: 優先して使いたいモデル名
+        fallback: primaryがない場合に使うモデル名
+    
+    Returns:
+        使用するモデル名
+    """
+    try:
+        models_response = list_models()
+        available = {model.model for model in models_response.models}
+    except Exception:
+        return fallback
+    
+    if primary in available or f"{primary}:latest" in available:
+        return primary
+    
+    console.print(f"[dim]フォールバックモデル {fallback} を使用[/dim]")
+    return fallback
+
 
 class PromptGenerator:
     """プロンプト生成器
@@ -26,6 +90,7 @@ class PromptGenerator:
         """
         self.config = config
         self.cache = {}
+        self._disk_cache = self._load_disk_cache()
     
     def get_context(self, theme: str) -> Dict[str, Any]:
         """テーマに応じたコンテキスト取得
@@ -38,7 +103,8 @@ class PromptGenerator:
         """
         # キャッシュチェック
         if theme in self.cache:
-            console.print("[dim]💾 キャッシュからプロンプトを取得[/dim]")
+            console.print("💾 キャッシュからプロンプトを取得",
+                          style="dim", markup=False, highlight=False)
             return self.cache[theme]
         
         # プリセットから探す
@@ -113,17 +179,21 @@ class PromptGenerator:
 """
         
         try:
-            # モデルの選択（12Bが利用可能か確認）
-            model = model_config.get("model", "gemma3:4b")
-            try:
-                ollama.chat(
-                    model=model,
-                    messages=[{"role": "user", "content": "test"}],
-                    options={"num_predict": 1}
-                )
-            except:
-                model = model_config.get("fallback_model", "gemma3:4b")
-                console.print(f"[dim]フォールバックモデル {model} を使用[/dim]")
+            model = _resolve_model(
+                model_config.get("model", "gemma3:4b"),
+                model_config.get("fallback_model", "gemma3:4b")
+            )
+            
+            options = {
+                "temperature": model_config.get("temperature", 0.3),
+                "num_predict": model_config.get("num_predict", 500)
+            }
+            
+            # 前回までの実行で同じ条件から生成済みならそれを使う
+            cache_key = self._cache_key(model, prompt, options)
+            if cache_key in self._disk_cache:
+                console.print("[dim]💾 保存済みのプロンプトを使用[/dim]")
+                return self._disk_cache[cache_key]
             
             response = ollama.chat(
                 model=model,
@@ -131,21 +201,18 @@ class PromptGenerator:
                     {"role": "system", "content": "あなたは物語の設定を分析する専門家です。論理的で建設的な批評設定を作ります。"},
                     {"role": "user", "content": prompt}
                 ],
-                options={
-                    "temperature": model_config.get("temperature", 0.3),
-                    "num_predict": model_config.get("num_predict", 500)
-                }
+                options=options,
+                keep_alive=self.config.get("keep_alive", "30m")
             )
             
             content = response['message']['content']
             
-            # JSONを抽出
-            content = re.sub(r'```json\n?', '', content)
-            content = re.sub(r'```\n?', '', content)
-            
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
+            # JSONを抽出（コードフェンスや後続の説明文は読み飛ばす）
+            start = content.find('{')
+            if start != -1:
+                context, _ = _JSON_DECODER.raw_decode(content, start)
+                self._store_disk_cache(cache_key, context)
+                return context
                 
         except Exception as e:
             console.print(f"[red]⚠️ プロンプト生成エラー: {e}[/red]")
@@ -153,6 +220,56 @@ class PromptGenerator:
         # フォールバック
         return self._get_fallback_context(theme)
     
+    def _cache_key(self, model: str, prompt: str, options: Dict[str, Any]) -> str:
+        """ディスクキャッシュのキーを計算
+        
+        プロンプト本文（テーマを含む）をハッシュするので、
+        テンプレートを編集すると古いエントリは自動的に使われなくなる
+        
+        Args:
+            model: 使用するモデル名
+            prompt: 生成に使うプロンプト
+            options: 生成オプション
+        
+        Returns:
+            SHA-256の16進文字列
+        """
+        payload = json_bytes({"model": model, "prompt": prompt, "options": options})
+        return hashlib.sha256(payload).hexdigest()
+    
+    def _load_disk_cache(self) -> Dict[str, Dict[str, Any]]:
+        """保存済みのコンテキストを読み込む
+        
+        Returns:
+            生成条件のハッシュをキーとしたコンテキストの辞書
+        """
+        try:
+            return load_json(PROMPT_CACHE_PATH)
+        except (OSError, ValueError):
+            return {}
+    
+    def _store_disk_cache(self, cache_key: str, context: Dict[str, Any]):
+        """コンテキストを追加してファイルに書き出す（一時ファイル経由で置き換え）
+        
+        複数スレッドから同時に呼ばれるので、追加と書き出しをまとめてロックで直列化し、
+        書き出しには追加時点の複製を使う
+        
+        Args:
+            cache_key: 生成条件のハッシュ
+            context: 生成されたコンテキスト
+        """
+        # 一時ファイルはプロセスごとに分ける
+        tmp_path = f"{PROMPT_CACHE_PATH}.{os.getpid()}.tmp"
+        with _DISK_CACHE_LOCK:
+            self._disk_cache[cache_key] = context
+            snapshot = dict(self._disk_cache)
+            try:
+                ensure_dir(os.path.dirname(PROMPT_CACHE_PATH))
+                save_json(tmp_path, snapshot)
+                os.replace(tmp_path, PROMPT_CACHE_PATH)
+            except OSError as e:
+                console.print(f"[dim]プロンプトキャッシュを保存できません: {e}[/dim]")
+    
     def _get_fallback_context(self, theme: str) -> Dict[str, Any]:
         """フォールバック用の汎用コンテキスト
         
@@ -238,9 +355,30 @@ class SmartDirector:
         self.contradiction_count = 0
         self.last_contradiction_turn = -1
         self.story_momentum = 0
-        self.critic_patterns = []
+        self.last_pattern = None  # 直前の批評パターン
+        self.pattern_streak = 0  # 同じパターンが続いている回数
         self.question_count = 0
     
+    # 状況に応じた指示（呼び出し側では変更しない）
+    _CHANGE_PATTERN = {"to": "critic", "action": "change_pattern", "note": "パターンを変える"}
+    _BREAKTHROUGH = {"to": "narrator", "action": "breakthrough", "note": "新展開で突破"}
+    _ANSWER_QUESTIONS = {"to": "narrator", "action": "develop", "note": "詳細に展開"}
+    _DEEPEN = {"to": "narrator", "action": "develop", "note": "物語を深める"}
+    _ANALYZE = {"to": "critic", "action": "analyze", "note": "詳細に分析"}
+    
+    # ターンごとの基本戦略（Noneのターンは物語の勢いで分岐、最後の要素は以降も継続）
+    _TURN_PLAN = (
+        {"to": "critic", "action": "listen", "note": "まず聞く"},
+        {"to": "critic", "action": "listen", "note": "興味を示す"},
+        {"to": "critic", "action": "question", "note": "興味を示す"},
+        {"to": "critic", "action": "analyze", "note": "掘り下げる"},
+        {"to": "critic", "action": "question", "note": "掘り下げる"},
+        None,
+        None,
+        {"to": "narrator", "action": "climax", "note": "クライマックス"},
+        {"to": "critic", "action": "final_doubt", "note": "締めの感想"},
+    )
+    
     def analyze_critic_response(self, text: str) -> str:
         """批評のパターンを分析（改良版）
         
@@ -250,18 +388,10 @@ class SmartDirector:
         Returns:
             パターンの種類（contradiction/question/backchannel/comment）
         """
-        # より柔軟なパターン認識
-        if "ない？" in text or "じゃない？" in text or "違わない？" in text:
-            return "contradiction"
-        elif "？" in text:
+        pattern = classify_critic(text)
+        if pattern == "question":
             self.question_count += 1
-            return "question"
-        elif len(text) <= 5:
-            return "backchannel"  # 相槌
-        elif "！" in text or "おお" in text or "すごい" in text:
-            return "exclamation"  # 感嘆
-        else:
-            return "comment"
+        return pattern
     
     def get_instruction(self, turn: int, last_critic: str = "", last_narrator: str = "") -> Dict:
         """状況に応じた適切な指示（改良版）
@@ -277,82 +407,32 @@ class SmartDirector:
         # 批評パターンを記録
         if last_critic:
             pattern = self.analyze_critic_response(last_critic)
-            self.critic_patterns.append(pattern)
+            if pattern == self.last_pattern:
+                self.pattern_streak += 1
+            else:
+                self.last_pattern = pattern
+                self.pattern_streak = 1
             
             if pattern == "contradiction":
                 self.contradiction_count += 1
                 self.last_contradiction_turn = turn
         
         # 同じパターンが3回続いたら変更を促す
-        if len(self.critic_patterns) >= 3:
-            recent = self.critic_patterns[-3:]
-            if len(set(recent)) == 1:  # 全部同じ
-                return {
-                    "to": "critic",
-                    "action": "change_pattern",
-                    "note": "パターンを変える"
-                }
+        if self.pattern_streak >= 3:
+            return self._CHANGE_PATTERN
         
         # 矛盾が多すぎる場合は突破口を
         if self.contradiction_count > 2 and turn - self.last_contradiction_turn < 2:
-            return {
-                "to": "narrator",
-                "action": "breakthrough",
-                "note": "新展開で突破"
-            }
+            return self._BREAKTHROUGH
         
         # 質問が多い場合は詳細な説明を
         if self.question_count > 2:
             self.question_count = 0  # リセット
-            return {
-                "to": "narrator",
-                "action": "develop",
-                "note": "詳細に展開"
-            }
+            return self._ANSWER_QUESTIONS
         
         # ターンに応じた基本戦略（改良版）
-        if turn == 0:
-            return {
-                "to": "critic",
-                "action": "listen",
-                "note": "まず聞く"
-            }
-        elif turn < 3:
-            return {
-                "to": "critic",
-                "action": "listen" if turn % 2 == 1 else "question",
-                "note": "興味を示す"
-            }
-        elif turn < 5:
-            return {
-                "to": "critic",
-                "action": "question" if turn % 2 == 0 else "analyze",
-                "note": "掘り下げる"
-            }
-        elif turn < 7:
-            if self.story_momentum < 3:
-                return {
-                    "to": "narrator",
-                    "action": "develop",
-                    "note": "物語を深める"
-                }
-            else:
-                return {
-                    "to": "critic",
-                    "action": "analyze",
-                    "note": "詳細に分析"
-                }
-        else:
-            # 終盤
-            if turn == 7:
-                return {
-                    "to": "narrator",
-                    "action": "climax",
-                    "note": "クライマックス"
-                }
-            else:
-                return {
-                    "to": "critic",
-                    "action": "final_doubt",
-                    "note": "締めの感想"
-                }
\ No newline at end of file
+        plan = self._TURN_PLAN[min(turn, len(self._TURN_PLAN) - 1)]
+        if plan is None:
+            # 中盤は物語の勢いで分岐
+            return self._DEEPEN if self.story_momentum < 3 else self._ANALYZE
+        return plan
@@ -3,20 +3,90 @@
 改良版：批評反映機能を持つ対話システム
 """
 
-import json
 import re
-from typing import Dict, List, Optional, Any
+import sys
+import asyncio
+import functools
+from collections import deque
+from itertools import islice
+from typing import Dict, List, Optional, Any, Callable
 
 import ollama
 from rich.console import Console
 from rich.panel import Panel
 from colorama import Fore, Style
 
-from components import PromptGenerator, SmartDirector
-from utils import clean_response
+from components import PromptGenerator, SmartDirector, classify_critic
+from utils import clean_response, load_json, request_key, load_cached_response, store_cached_response
 
 console = Console()
 
+# 役割ごとの表示の行頭と、プロンプトに含める対話履歴での役割名（毎ターン組み立て直さない）
+_ROLE_STYLE = {
+    "narrator": (f"{Fore.MAGENTA}語り:{Style.RESET_ALL} ", "語り手"),
+    "critic": (f"{Fore.CYAN}批評:{Style.RESET_ALL} ", "批評"),
+}
+_TURN_SEPARATOR = "-" * 40 + "\n"
+
+# 語り手の文を区切る句読点
+_SENT_SPLIT_RE = re.compile(r'[。！？]')
+
+
+def _limit_sentences(text: str, max_sentences: int) -> str:
+    """文数を制限する（空の文は数えない）
+    
+    制限を超えた場合は先頭の文を「。」でつないで返す。
+    超えたことが分かった時点で走査を打ち切る。
+    
+    Args:
+        text: 対象のテキスト
+        max_sentences: 残す文の数
+    
+    Returns:
+        制限後のテキスト
+    """
+    kept = []
+    start = 0
+    for match in _SENT_SPLIT_RE.finditer(text):
+        segment = text[start:match.start()]
+        start = match.end()
+        if segment.strip():
+            if len(kept) == max_sentences:
+                return '。'.join(kept) + '。'
+            kept.append(segment)
+    
+    # 最後の句読点の後ろに残った文
+    if len(kept) == max_sentences and text[start:].strip():
+        return '。'.join(kept) + '。'
+    return text
+
+
+def _narrator_done(content: str) -> bool:
+    """語り: 3文目が始まったら2文制限の結果は変わらない"""
+    text = clean_response(content, "narrator")
+    return _limit_sentences(text, 2) != text
+
+
+def _critic_done(content: str) -> bool:
+    """批評: 20文字を超えて「？」が出たら切り詰め結果は変わらない"""
+    text = clean_response(content, "critic")
+    return len(text) > 20 and "？" in text
+
+
+@functools.lru_cache(maxsize=4)
+def _load_config(config_path: str) -> Dict[str, Any]:
+    """設定ファイルを読み込む（同じパスはプロセス内で1回だけ解析）
+    
+    返す辞書は全インスタンスで共有するので変更しないこと
+    
+    Args:
+        config_path: 設定ファイルのパス
+    
+    Returns:
+        設定の辞書
+    """
+    return load_json(config_path)
+
 
 class DialogueSystem:
     """統合された対話システム
@@ -24,31 +94,110 @@ class DialogueSystem:
     語り手と批評者の対話を管理し、実行する
     """
     
-    def __init__(self, theme: str, config_path: str = "config.json"):
+    def __init__(self, theme: str, config_path: str = "config.json",
+                 aclient: Optional[ollama.AsyncClient] = None,
+                 prompt_generator: Optional[PromptGenerator] = None):
         """
         Args:
             theme: 対話のテーマ
             config_path: 設定ファイルのパス
+            aclient: 共有する非同期クライアント（省略時は専用に作成）
+            prompt_generator: 共有するプロンプト生成器（省略時は専用に作成）
         """
         # 設定読み込み
-        with open(config_path, 'r', encoding='utf-8') as f:
-            self.config = json.load(f)
+        self.config = _load_config(config_path)
         
         self.theme = theme
         self.dialogue = []
         self.turn = 0
+        self._recent_lines = deque(maxlen=6)  # プロンプト用に整形済みの直近の発言（役割, 行）
+        
+        # 非同期クライアント（接続はこの対話の間使い回す）
+        self.aclient = aclient or ollama.AsyncClient()
+        # 役割ごとに接続先が設定されていれば、そのサーバー専用のクライアントを使う
+        hosts = self.config.get("hosts", {})
+        self.clients = {
+            role: ollama.AsyncClient(host=hosts[role]) if hosts.get(role) else self.aclient
+            for role in ("narrator", "critic")
+        }
         
         # コンポーネント初期化
-        self.prompt_generator = PromptGenerator(self.config)
+        self.prompt_generator = prompt_generator or PromptGenerator(self.config)
         self.director = SmartDirector()
         
         # 批評用プロンプト生成
         self.context = self.prompt_generator.get_context(theme)
         self.critic_prompt = self.prompt_generator.create_critic_prompt(self.context)
         
+        # 毎ターン同じになるプロンプトは事前に組み立てておく
+        self.narrator_system_prompt = f"""あなたは「{self.theme}」の物語を語る語り手です。
+
+### 重要なルール
+1. 物語の描写のみを行う
+2. 批評への言及は絶対禁止（「という質問」「という指摘」など）
+3. 批評の内容は物語の展開で自然に解決する
+4. 具体的で視覚的な描写を心がける
+5. 2文以内で簡潔に表現する
+
+### 物語の一貫性
+- 設定した世界観を守る
+- 前の描写と矛盾しない
+- 批評で指摘された点は修正または説明する"""
+        self.critic_instructions = self._build_critic_instructions()
+        
+        # 改良された批評システムプロンプト
+        facts = self.context.get('facts', [])
+        self.critic_system_prompt = f"""あなたは{self.context.get('personality', '懐疑的')}な批評家です。
+
+### 基本ルール
+1. 必ず20文字以内で返答
+2. 断定的な否定（「ありえない！」）は避ける
+3. 疑問形で優しく指摘する（「〜じゃない？」「〜なの？」）
+4. 具体的な要素を挙げて質問する
+
+### この物語の重要な事実
+{chr(10).join(['・' + fact for fact in facts[:3]])}
+
+### 良い批評の例
+- 「水があるってありえなくない？」
+- 「それって前と違わない？」
+- 「場所はどこなの？」
+- 「おお、展開が面白い！」
+
+### 悪い批評の例
+- 「ありえない！」（断定的すぎる）
+- 「矛盾している」（具体性がない）
+- 「違う」（短すぎて不親切）"""
+        
         # デバッグ表示
         self._show_context()
     
+    def _build_critic_instructions(self) -> Dict[str, str]:
+        """批評のアクションごとの指示文を構築
+        
+        Returns:
+            アクション名をキーとした指示文の辞書
+        """
+        forbidden_items = self.context.get('forbidden', [])
+        
+        return {
+            "listen": "相槌を打って。5文字以内。（例：へー、ふーん、それで？）",
+            "question": "短い質問をして。10文字以内。（例：どこで？、なぜ？、いつ？）",
+            "analyze": f"""
+矛盾や疑問があれば具体的に指摘。なければ短い感想。20文字以内。
+
+### 禁止要素（これらは存在しないはず）
+{', '.join(forbidden_items)}
+
+### 指摘の例
+- 「{forbidden_items[0] if forbidden_items else '水'}ってありえなくない？」
+- 「それって矛盾してない？」
+- 「〜じゃないの？」
+""",
+            "change_pattern": "いつもと違う反応を。感嘆や驚き。15文字以内。",
+            "final_doubt": "最後の疑問や感想。15文字以内。"
+        }
+    
     def _show_context(self):
         """生成されたコンテキストを表示"""
         console.print("\n[bold cyan]📋 生成された批評設定[/bold cyan]")
@@ -58,6 +207,17 @@ class DialogueSystem:
         console.print()
     
     def run_dialogue(self, max_turns: int = 10) -> List[Dict]:
+        """対話の実行（同期版）
+        
+        Args:
+            max_turns: 最大ターン数
+        
+        Returns:
+            対話履歴のリスト
+        """
+        return asyncio.run(self.run_dialogue_async(max_turns))
+    
+    async def run_dialogue_async(self, max_turns: int = 10) -> List[Dict]:
         """対話の実行
         
         Args:
@@ -76,25 +236,21 @@ class DialogueSystem:
             
             # 進行役の判断
             instruction = self.director.get_instruction(turn, critic_text, narrator_text)
-            console.print(f"[dim]進行→{instruction['to']}: {instruction['note']}[/dim]")
+            # 毎ターン出る行はマークアップ解析を通さずにスタイルだけ当てる
+            console.print(f"進行→{instruction['to']}: {instruction['note']}",
+                          style="dim", markup=False, highlight=False)
             
             # 語り手のターン
             if turn == 0 or instruction["to"] == "narrator":
-                narrator_text = self.get_narrator_response(
+                narrator_text = await self.get_narrator_response(
                     critic_text,
                     instruction.get("action", "continue")
                 )
-                print(f"{Fore.MAGENTA}語り:{Style.RESET_ALL} {narrator_text}")
-                self.dialogue.append({
-                    "role": "narrator",
-                    "content": narrator_text,
-                    "turn": turn
-                })
-                self.director.story_momentum += 1
+                self._commit_entry("narrator", narrator_text, turn)
             
             # 批評のターン
             if turn < max_turns - 1 and (turn == 0 or instruction["to"] == "critic"):
-                critic_text = self.get_critic_response(
+                critic_text = await self.get_critic_response(
                     narrator_text,
                     instruction.get("action", "listen")
                 )
@@ -102,32 +258,92 @@ class DialogueSystem:
                 # パターン分析
                 pattern = self.director.analyze_critic_response(critic_text)
                 if pattern == "contradiction":
-                    console.print(f"[yellow]⚠️ 矛盾指摘: {critic_text}[/yellow]")
+                    console.print(f"⚠️ 矛盾指摘: {critic_text}",
+                                  style="yellow", markup=False, highlight=False)
                 
-                print(f"{Fore.CYAN}批評:{Style.RESET_ALL} {critic_text}")
-                self.dialogue.append({
-                    "role": "critic",
-                    "content": critic_text,
-                    "turn": turn,
-                    "pattern": pattern
-                })
+                self._commit_entry("critic", critic_text, turn, pattern)
                 
-                # 批評後の語り手継続
-                if instruction["to"] == "critic" and turn < max_turns - 2:
-                    narrator_text = self.get_narrator_response(critic_text)
-                    print(f"{Fore.MAGENTA}語り:{Style.RESET_ALL} {narrator_text}")
-                    self.dialogue.append({
-                        "role": "narrator",
-                        "content": narrator_text,
-                        "turn": turn
-                    })
-                    self.director.story_momentum += 1
+                # 批評後の語り手継続（設定により相槌だけの場合は省略）
+                skip = pattern == "backchannel" and self.config.get("skip_narrator_on_backchannel", False)
+                if instruction["to"] == "critic" and turn < max_turns - 2 and not skip:
+                    narrator_text = await self.get_narrator_response(critic_text)
+                    self._commit_entry("narrator", narrator_text, turn)
             
-            print("-" * 40)
+            sys.stdout.write(_TURN_SEPARATOR)
         
         return self.dialogue
     
-    def get_narrator_response(self, critic_text: str = "", action: str = "continue") -> str:
+    def _commit_entry(self, role: str, content: str, turn: int, pattern: Optional[str] = None):
+        """発言を表示し、対話履歴とプロンプト用の直近履歴に記録する
+        
+        Args:
+            role: 役割（"narrator" or "critic"）
+            content: 発言のテキスト
+            turn: 現在のターン数
+            pattern: 批評のパターン（批評のみ）
+        """
+        prefix, label = _ROLE_STYLE[role]
+        sys.stdout.write(prefix + content + "\n")
+        
+        entry = {"role": role, "content": content, "turn": turn}
+        if pattern is not None:
+            entry["pattern"] = pattern
+        self.dialogue.append(entry)
+        self._recent_lines.append((role, f"{label}: {content}\n"))
+        
+        if role == "narrator":
+            self.director.story_momentum += 1
+    
+    async def _stream_chat(self, role: str, messages: List[Dict[str, str]],
+                           done: Callable[[str], bool]) -> str:
+        """ストリーミングで応答を受け取り、結果が確定した時点で生成を打ち切る
+        
+        Args:
+            role: 役割（"narrator" or "critic"）
+            messages: 送信するメッセージ
+            done: 受信済みテキストを受け取り、打ち切ってよければTrueを返す関数
+        
+        Returns:
+            受信したテキスト
+        """
+        model_config = self.config["models"][role]
+        
+        # 応答キャッシュ（開発時の再実行用。同じリクエストならLLMを呼ばない）
+        cache_key = None
+        if self.config.get("response_cache", False):
+            cache_key = request_key({
+                "model": model_config["model"],
+                "messages": messages,
+                "options": model_config
+            })
+            cached = load_cached_response(cache_key)
+            if cached is not None:
+                return cached
+        
+        stream = await self.clients[role].chat(
+            model=model_config["model"],
+            messages=messages,
+            options=model_config,
+            keep_alive=self.config.get("keep_alive", "30m"),
+            stream=True
+        )
+        
+        content = ""
+        try:
+            async for chunk in stream:
+                content += chunk['message']['content']
+                if done(content):
+                    break
+        finally:
+            # 接続を閉じるとサーバー側の生成も止まる
+            await stream.aclose()
+        
+        if cache_key is not None:
+            store_cached_response(cache_key, content)
+        
+        return content
+    
+    async def get_narrator_response(self, critic_text: str = "", action: str = "continue") -> str:
         """語り手の応答を生成
         
         Args:
@@ -139,34 +355,29 @@ class DialogueSystem:
         """
         templates = self.config["prompts"]["narrator_templates"]
         
-        # 対話履歴を構築（直近の数ターン）
-        recent_history = ""
-        for entry in self.dialogue[-6:]:  # 直近6エントリ（約3往復）
-            if entry["role"] == "narrator":
-                recent_history += f"語り手: {entry['content']}\n"
-            elif entry["role"] == "critic":
-                recent_history += f"批評: {entry['content']}\n"
-        
         # 初回ターン
         if self.turn == 0:
             prompt = templates["start"].format(theme=self.theme)
         else:
             # アクションに応じた基本プロンプト選択
+            critic_pattern = classify_critic(critic_text) if critic_text else None
             if action == "breakthrough":
                 base_prompt = templates["breakthrough"]
             elif action == "develop":
                 base_prompt = templates["develop"]
             elif action == "climax":
                 base_prompt = templates["climax"]
-            elif critic_text and "？" in critic_text:
-                base_prompt = templates["with_question"]
-            elif critic_text and ("ない？" in critic_text or "じゃない？" in critic_text):
+            elif critic_pattern == "contradiction":
                 base_prompt = templates["with_contradiction"]
+            elif critic_pattern == "question":
+                base_prompt = templates["with_question"]
             else:
                 base_prompt = templates.get("continue", "物語を自然に続けてください。")
             
             # 批評の内容を物語への指示として含める
             if critic_text:
+                # 対話履歴（直近6エントリ、約3往復）
+                recent_history = "".join(line for _, line in self._recent_lines)
                 prompt = f"""
 ### これまでの対話
 {recent_history}
@@ -184,43 +395,18 @@ class DialogueSystem:
             else:
                 prompt = base_prompt
         
-        # システムプロンプト
-        system_prompt = f"""あなたは「{self.theme}」の物語を語る語り手です。
-
-### 重要なルール
-1. 物語の描写のみを行う
-2. 批評への言及は絶対禁止（「という質問」「という指摘」など）
-3. 批評の内容は物語の展開で自然に解決する
-4. 具体的で視覚的な描写を心がける
-5. 2文以内で簡潔に表現する
-
-### 物語の一貫性
-- 設定した世界観を守る
-- 前の描写と矛盾しない
-- 批評で指摘された点は修正または説明する"""
-        
         messages = [
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": self.narrator_system_prompt},
             {"role": "user", "content": prompt}
         ]
         
-        response = ollama.chat(
-            model=self.config["models"]["narrator"]["model"],
-            messages=messages,
-            options=self.config["models"]["narrator"]
-        )
-        
-        text = clean_response(response['message']['content'], "narrator")
+        content = await self._stream_chat("narrator", messages, _narrator_done)
+        text = clean_response(content, "narrator")
         
         # 2文制限
-        sentences = re.split(r'[。！？]', text)
-        sentences = [s for s in sentences if s.strip()]
-        if len(sentences) > 2:
-            text = '。'.join(sentences[:2]) + '。'
-        
-        return text
+        return _limit_sentences(text, 2)
     
-    def get_critic_response(self, narrator_text: str, action: str = "listen") -> str:
+    async def get_critic_response(self, narrator_text: str, action: str = "listen") -> str:
         """批評の応答を生成
         
         Args:
@@ -230,39 +416,12 @@ class DialogueSystem:
         Returns:
             批評の応答テキスト
         """
-        # 批評用の改良されたプロンプト
-        forbidden_items = self.context.get('forbidden', [])
-        facts = self.context.get('facts', [])
-        
         # アクションに応じたプロンプト
-        if action == "listen":
-            instruction = "相槌を打って。5文字以内。（例：へー、ふーん、それで？）"
-        elif action == "question":
-            instruction = "短い質問をして。10文字以内。（例：どこで？、なぜ？、いつ？）"
-        elif action == "analyze":
-            instruction = f"""
-矛盾や疑問があれば具体的に指摘。なければ短い感想。20文字以内。
-
-### 禁止要素（これらは存在しないはず）
-{', '.join(forbidden_items)}
-
-### 指摘の例
-- 「{forbidden_items[0] if forbidden_items else '水'}ってありえなくない？」
-- 「それって矛盾してない？」
-- 「〜じゃないの？」
-"""
-        elif action == "change_pattern":
-            instruction = "いつもと違う反応を。感嘆や驚き。15文字以内。"
-        elif action == "final_doubt":
-            instruction = "最後の疑問や感想。15文字以内。"
-        else:
-            instruction = "反応して。10文字以内。"
+        instruction = self.critic_instructions.get(action, "反応して。10文字以内。")
         
         # 対話履歴を含める
-        recent_history = ""
-        for entry in self.dialogue[-4:]:  # 直近4エントリ
-            if entry["role"] == "narrator":
-                recent_history += f"語り手: {entry['content']}\n"
+        recent = islice(self._recent_lines, max(len(self._recent_lines) - 4, 0), None)  # 直近4エントリ
+        recent_history = "".join(line for role, line in recent if role == "narrator")
         
         prompt = f"""
 ### これまでの物語
@@ -275,51 +434,25 @@ class DialogueSystem:
 {instruction}
 """
         
-        # 改良された批評システムプロンプト
-        enhanced_critic_prompt = f"""あなたは{self.context.get('personality', '懐疑的')}な批評家です。
-
-### 基本ルール
-1. 必ず20文字以内で返答
-2. 断定的な否定（「ありえない！」）は避ける
-3. 疑問形で優しく指摘する（「〜じゃない？」「〜なの？」）
-4. 具体的な要素を挙げて質問する
-
-### この物語の重要な事実
-{chr(10).join(['・' + fact for fact in facts[:3]])}
-
-### 良い批評の例
-- 「水があるってありえなくない？」
-- 「それって前と違わない？」
-- 「場所はどこなの？」
-- 「おお、展開が面白い！」
-
-### 悪い批評の例
-- 「ありえない！」（断定的すぎる）
-- 「矛盾している」（具体性がない）
-- 「違う」（短すぎて不親切）"""
-        
-        response = ollama.chat(
-            model=self.config["models"]["critic"]["model"],
-            messages=[
-                {"role": "system", "content": enhanced_critic_prompt},
-                {"role": "user", "content": prompt}
-            ],
-            options=self.config["models"]["critic"]
-        )
+        messages = [
+            {"role": "system", "content": self.critic_system_prompt},
+            {"role": "user", "content": prompt}
+        ]
         
-        text = clean_response(response['message']['content'], "critic")
+        content = await self._stream_chat("critic", messages, _critic_done)
+        text = clean_response(content, "critic")
         
         # 長さ制限（20文字）
         if len(text) > 20:
-            # 疑問符で終わるように調整
-            if "？" in text:
-                text = text.split("？")[0] + "？"
+            # 疑問符で終わるように調整（最初の区切りまでを残す）
+            end = text.find("？")
+            if end != -1:
+                text = text[:end + 1]
             else:
-                for delimiter in ['。', '！', '、']:
-                    if delimiter in text:
-                        text = text.split(delimiter)[0]
-                        if not text.endswith("？"):
-                            text += "？"
+                for delimiter in ('。', '！', '、'):
+                    end = text.find(delimiter)
+                    if end != -1:
+                        text = text[:end] + "？"
                         break
                 else:
                     text = text[:18] + "？"
@@ -342,19 +475,67 @@ class DialogueSystem:
             }
         }
         
-        # パターン集計
+        # パターン集計と文字数集計を1回の走査で行う
+        patterns = analysis["patterns"]
+        counts = {"narrator": 0, "critic": 0}
+        total_lengths = {"narrator": 0, "critic": 0}
         for entry in self.dialogue:
-            if entry["role"] == "critic" and "pattern" in entry:
+            role = entry["role"]
+            if role not in counts:
+                continue
+            counts[role] += 1
+            total_lengths[role] += len(entry["content"])
+            if role == "critic" and "pattern" in entry:
                 pattern = entry["pattern"]
-                analysis["patterns"][pattern] = analysis["patterns"].get(pattern, 0) + 1
+                patterns[pattern] = patterns.get(pattern, 0) + 1
         
         # 平均文字数
-        narrator_lengths = [len(e["content"]) for e in self.dialogue if e["role"] == "narrator"]
-        critic_lengths = [len(e["content"]) for e in self.dialogue if e["role"] == "critic"]
+        for role, count in counts.items():
+            if count:
+                analysis["avg_length"][role] = total_lengths[role] / count
         
-        if narrator_lengths:
-            analysis["avg_length"]["narrator"] = sum(narrator_lengths) / len(narrator_lengths)
-        if critic_lengths:
-            analysis["avg_length"]["critic"] = sum(critic_lengths) / len(critic_lengths)
-        
-        return analysis
\ No newline at end of file
+        return analysis
+
+
+async def run_many(themes: List[str], max_turns: int = 10, concurrency: int = 4,
+                   config_path: str = "config.json") -> List[DialogueSystem]:
+    """複数テーマの対話を並行して実行する
+    
+    同時に流れる対話はOllamaサーバー側でまとめて処理される。
+    サーバーの並列数（OLLAMA_NUM_PARALLEL）に合わせてconcurrencyを指定する。
+    各対話の表示は混ざって出力される。
+    テーマごとのコンテキスト生成は最初にまとめて始めておき、
+    先に始まった対話の裏で後続のテーマの準備を進める。
+    
+    Args:
+        themes: 対話のテーマのリスト
+        max_turns: 各対話の最大ターン数
+        concurrency: 同時に実行する対話の数
+        config_path: 設定ファイルのパス
+    
+    Returns:
+        実行済みのDialogueSystemのリスト（themesと同じ順）
+    """
+    aclient = ollama.AsyncClient()
+    generator = PromptGenerator(_load_config(config_path))
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    # プロンプト生成は同期的にブロックするので別スレッドで先行して走らせる
+    # （同時に生成するのはconcurrency件まで）
+    prefetch_slots = asyncio.Semaphore(concurrency)
+    
+    async def prefetch(theme: str) -> Dict[str, Any]:
+        async with prefetch_slots:
+            return await asyncio.to_thread(generator.get_context, theme)
+    
+    contexts = {theme: asyncio.create_task(prefetch(theme)) for theme in dict.fromkeys(themes)}
+    
+    async def run_one(theme: str) -> DialogueSystem:
+        async with semaphore:
+            await contexts[theme]
+            # 生成済みのコンテキストはgeneratorのキャッシュから取り出される
+            system = await asyncio.to_thread(DialogueSystem, theme, config_path, aclient, generator)
+            await system.run_dialogue_async(max_turns)
+            return system
+    
+    return await asyncio.gather(*(run_one(theme) for theme in themes))
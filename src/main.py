@@ -3,19 +3,23 @@
 エントリーポイントとUI
 """
 
+import os
 import sys
-import json
+import threading
 import ollama
 from rich.console import Console
 from colorama import init
 
 # リファクタリング後のインポート
 from dialogue_system import DialogueSystem
-from utils import check_ollama, save_dialogue
+from utils import check_ollama, list_models, load_json, save_json, save_dialogue
 
 init(autoreset=True)
 console = Console()
 
+# モデルを常駐させる時間（config.jsonに指定がない場合）
+DEFAULT_KEEP_ALIVE = "30m"
+
 
 def check_models():
     """必要なモデルの確認"""
@@ -32,17 +36,18 @@ def check_models():
         
         console.print("[green]✅ Ollama接続OK[/green]")
         
-        # 必要なモデルの確認
-        models_response = ollama.list()
-        available_models = []
-        
-        if hasattr(models_response, 'models'):
-            for model in models_response.models:
-                if hasattr(model, 'model'):
-                    available_models.append(model.model)
+        # 必要なモデルの確認（接続確認で取得済みの一覧を使う）
+        models_response = list_models()
+        available_models = {
+            model.model for model in getattr(models_response, 'models', ())
+            if hasattr(model, 'model')
+        }
         
-        has_4b = any("gemma3:4b" in m for m in available_models)
-        has_12b = any("gemma3:12b" in m for m in available_models)
+        # 完全一致は集合で判定し、無ければタグ違い（gemma3:4b-it-qatなど）を探す
+        has_4b, has_12b = (
+            name in available_models or any(name in m for m in available_models)
+            for name in ("gemma3:4b", "gemma3:12b")
+        )
         
         if not has_4b:
             console.print("[red]❌ Gemma3:4b が見つかりません[/red]")
@@ -55,13 +60,13 @@ def check_models():
         if not has_12b:
             console.print("[yellow]⚠️ Gemma3:12b が見つかりません（オプション）[/yellow]")
             console.print("[dim]プロンプト生成に4Bモデルを使用します[/dim]")
-            # config.jsonの設定を更新
+            # config.jsonの設定を更新（変更がある場合だけ、一時ファイル経由で置き換え）
             try:
-                with open("config.json", 'r', encoding='utf-8') as f:
-                    config = json.load(f)
-                config["models"]["prompt_generator"]["model"] = "gemma3:4b"
-                with open("config.json", 'w', encoding='utf-8') as f:
-                    json.dump(config, f, ensure_ascii=False, indent=2)
+                config = load_json("config.json")
+                if config["models"]["prompt_generator"]["model"] != "gemma3:4b":
+                    config["models"]["prompt_generator"]["model"] = "gemma3:4b"
+                    save_json("config.json.tmp", config)
+                    os.replace("config.json.tmp", "config.json")
             except:
                 pass
         else:
@@ -74,13 +79,50 @@ def check_models():
         return False
 
 
+def start_warmup(config_path: str = "config.json") -> threading.Thread:
+    """テーマ選択を待つ間に、語り手・批評者のモデルをバックグラウンドでロードする
+    
+    Args:
+        config_path: 設定ファイルのパス
+    
+    Returns:
+        ウォームアップを実行しているスレッド
+    """
+    try:
+        config = load_json(config_path)
+        # 役割ごとの接続先（DialogueSystem.clientsと同じ。未指定は既定の接続先）
+        hosts = config.get("hosts", {})
+        targets = sorted({
+            (hosts.get(role) or "", config["models"][role]["model"])
+            for role in ("narrator", "critic")
+        })
+        keep_alive = config.get("keep_alive", DEFAULT_KEEP_ALIVE)
+    except Exception:
+        targets = [("", "gemma3:4b")]
+        keep_alive = DEFAULT_KEEP_ALIVE
+    
+    def _warm():
+        clients = {}
+        for host, model in targets:
+            try:
+                if host not in clients:
+                    clients[host] = ollama.Client(host=host) if host else ollama
+                # 空プロンプトのgenerateはモデルのロードだけを行う
+                clients[host].generate(model=model, prompt="", keep_alive=keep_alive)
+            except Exception:
+                pass  # 失敗しても本番の呼び出しでロードされる
+    
+    thread = threading.Thread(target=_warm, daemon=True)
+    thread.start()
+    return thread
+
+
 def select_theme():
     """テーマ選択"""
     # config.jsonからテーマリストを読み込む
     try:
-        with open("config.json", 'r', encoding='utf-8') as f:
-            config = json.load(f)
-            themes = config.get("theme_list", [])
+        config = load_json("config.json")
+        themes = config.get("theme_list", [])
     except:
         # フォールバック
         themes = [
@@ -122,7 +164,8 @@ def main():
     if not check_models():
         return 1
     
-    # テーマ選択
+    # テーマ選択（入力待ちの間にモデルをロード）
+    start_warmup()
     selected_theme = select_theme()
     console.print(f"\n[bold cyan]選択されたテーマ: {selected_theme}[/bold cyan]\n")
     
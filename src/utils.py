@@ -6,18 +6,170 @@
 import json
 import re
 import os
+import hashlib
+import functools
 from datetime import datetime
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
 
 import ollama
 from rich.console import Console
 
+# orjson があれば高速なC実装を使い、なければ標準ライブラリにフォールバック
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 console = Console()
 
 
+@functools.lru_cache(maxsize=None)
+def ensure_dir(path: str) -> str:
+    """ディレクトリを作成する（同じパスはプロセス内で1回だけ）
+    
+    Args:
+        path: 作成するディレクトリのパス
+    
+    Returns:
+        作成したディレクトリのパス
+    """
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def load_json(path: str) -> Any:
+    """JSONファイルを読み込む（orjson優先）
+    
+    Args:
+        path: 読み込むファイルのパス
+    
+    Returns:
+        デコードしたデータ
+    """
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_json(path: str, data: Any):
+    """データをインデント付きJSONとしてUTF-8で書き出す（orjson優先）
+    
+    Args:
+        path: 書き出すファイルのパス
+        data: 書き出すデータ
+    """
+    if orjson is not None:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        return
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def json_bytes(data: Any) -> bytes:
+    """キーを整列した空白なしのJSONバイト列に変換（ハッシュ計算用）
+    
+    orjsonの有無にかかわらず同じバイト列になるようにする
+    
+    Args:
+        data: 変換するデータ
+    
+    Returns:
+        UTF-8のJSONバイト列
+    """
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(
+        data, ensure_ascii=False, sort_keys=True, separators=(',', ':')
+    ).encode('utf-8')
+
+
+# 括弧・鉤括弧（取り除くと冒頭の言葉が現れることがあるので先に処理する）
+_BRACKET_RE = re.compile(r'\[.*?\]|「|」')
+
+# Gemma3が出力しやすい冒頭の言葉（この順に1回ずつ取り除く）
+_LEADING_PATTERN = r'^(?:はい、)?(?:ええと、)?(?:そうですね、)?'
+
+# 語り手のメタ発言
+_META_PHRASES = (
+    "承知しました",
+    "わかりました",
+    "理解しました",
+    "ご指摘",
+    "修正",
+    "確かに",
+    "という質問",
+    "という指摘",
+    "という疑問",
+    "に対する答え",
+    "に答える"
+)
+
+# 役割ごとの除去パターン（冒頭の言葉とメタ発言を1回の走査で取り除く）
+# メタ発言を先に並べ、冒頭の空マッチで先頭のメタ発言が見逃されないようにする
+_ROLE_CLEAN_RE = {
+    "narrator": re.compile('|'.join(map(re.escape, _META_PHRASES)) + '|' + _LEADING_PATTERN),
+    "critic": re.compile(_LEADING_PATTERN),
+}
+
+# LLM応答のキャッシュ（config.json の response_cache が true のときだけ使う）
+RESPONSE_CACHE_DIR = os.path.join("outputs", ".response_cache")
+
+
+def request_key(request: Dict[str, Any]) -> str:
+    """リクエスト内容からキャッシュのキーを計算
+    
+    Args:
+        request: モデル名・メッセージ・オプションなどをまとめた辞書
+    
+    Returns:
+        SHA-256の16進文字列
+    """
+    return hashlib.sha256(json_bytes(request)).hexdigest()
+
+
+def load_cached_response(key: str) -> Optional[str]:
+    """キャッシュ済みの応答を取得
+    
+    Args:
+        key: request_key() で計算したキー
+    
+    Returns:
+        応答テキスト（なければNone）
+    """
+    try:
+        with open(os.path.join(RESPONSE_CACHE_DIR, key + ".txt"), 'r', encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def store_cached_response(key: str, content: str):
+    """応答をキャッシュに保存（一時ファイル経由で置き換え）
+    
+    Args:
+        key: request_key() で計算したキー
+        content: 応答テキスト
+    """
+    try:
+        path = os.path.join(ensure_dir(RESPONSE_CACHE_DIR), key + ".txt")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        console.print(f"[dim]応答キャッシュを保存できません: {e}[/dim]")
+
+
+@functools.lru_cache(maxsize=2048)
 def clean_response(text: str, role: str) -> str:
     """応答のクリーニング
     
+    ストリーミング中の終了判定と最終結果の整形で同じ文字列を処理するため、
+    結果をキャッシュする（ヒット率は clean_response.cache_info() で確認できる）
+    
     Args:
         text: クリーニング対象のテキスト
         role: 役割（"narrator" or "critic"）
@@ -25,51 +177,41 @@ def clean_response(text: str, role: str) -> str:
     Returns:
         クリーニング済みのテキスト
     """
-    # Gemma3が出力しやすい不要なパターンを削除
-    patterns_to_remove = [
-        r'\[.*?\]',  # 括弧
-        r'「|」',    # 鉤括弧
-        r'^はい、',  # 冒頭の「はい」
-        r'^ええと、', # 冒頭の「ええと」
-        r'^そうですね、', # 冒頭の「そうですね」
-    ]
-    
-    for pattern in patterns_to_remove:
-        text = re.sub(pattern, '', text)
-    
-    # メタ発言の削除
-    if role == "narrator":
-        meta_phrases = [
-            "承知しました",
-            "わかりました",
-            "理解しました",
-            "ご指摘",
-            "修正",
-            "確かに",
-            "という質問",
-            "という指摘",
-            "という疑問",
-            "に対する答え",
-            "に答える"
-        ]
-        for phrase in meta_phrases:
-            text = text.replace(phrase, "")
-    
-    # 空白の正規化
-    text = ' '.join(text.split())
-    text = text.strip()
-    
-    return text
-
-
-def check_ollama() -> bool:
+    # 括弧を削除してから、冒頭の言葉と（語り手なら）メタ発言を削除
+    text = _BRACKET_RE.sub('', text)
+    text = _ROLE_CLEAN_RE.get(role, _ROLE_CLEAN_RE["critic"]).sub('', text)
+    
+    # 空白の正規化（split()は前後の空白も落とすのでstripは不要）
+    return ' '.join(text.split())
+
+
+@functools.lru_cache(maxsize=1)
+def list_models():
+    """インストール済みモデルの一覧を取得（プロセス内で1回だけ問い合わせる）
+    
+    失敗した場合は例外がそのまま送出され、結果はキャッシュされない
+    
+    Returns:
+        ollama.list() の応答
+    """
+    return ollama.list()
+
+
+def check_ollama(force_refresh: bool = False) -> bool:
     """Ollama接続確認
     
+    確認に使ったモデル一覧は list_models() にキャッシュされる
+    
+    Args:
+        force_refresh: Trueならキャッシュを破棄して問い合わせ直す
+    
     Returns:
         接続可能な場合True、そうでない場合False
     """
+    if force_refresh:
+        list_models.cache_clear()
     try:
-        models_response = ollama.list()
+        list_models()
         return True
     except:
         return False
@@ -87,8 +229,7 @@ def save_dialogue(dialogue: List[Dict], theme: str, analysis: Dict) -> str:
         保存したファイルのパス
     """
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    os.makedirs("outputs", exist_ok=True)
-    filename = f"outputs/dialogue_{timestamp}.json"
+    filename = os.path.join(ensure_dir("outputs"), f"dialogue_{timestamp}.json")
     
     save_data = {
         "theme": theme,
@@ -97,7 +238,6 @@ def save_dialogue(dialogue: List[Dict], theme: str, analysis: Dict) -> str:
         "timestamp": timestamp
     }
     
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(save_data, f, ensure_ascii=False, indent=2)
+    save_json(filename, save_data)
     
     return filename
\ No newline at end of file
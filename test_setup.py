@@ -7,7 +7,11 @@ Initial Setup and Test Script
 import os
 import sys
 import json
+import asyncio
 import time
+import shutil
+import itertools
+import subprocess
 from datetime import datetime
 from typing import Dict, List, Optional
 from dataclasses import dataclass, field
@@ -19,6 +23,18 @@ from rich.console import Console
 from rich.table import Table
 from rich.panel import Panel
 
+# 結果の保存はorjsonがあれば使う
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# GPU情報はNVMLから直接読む（未インストールならnvidia-smiを使う）
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
 # Colorama初期化
 init(autoreset=True)
 console = Console()
@@ -37,6 +53,9 @@ class SystemConfig:
     max_tokens_critic: int = 150
     max_tokens_director: int = 100
     
+    # 対話中にモデルがアンロードされないよう常駐させる時間
+    keep_alive: str = "30m"
+    
     log_dir: str = "./logs"
     output_dir: str = "./outputs"
     
@@ -62,13 +81,42 @@ PROMPTS = {
 例：{"to": "narrator", "emotion": "defensive", "style": "short", "instruction": "言い訳する"}"""
 }
 
+# 役割ごとの表示色（応答はストリーミングで逐次表示する）
+ROLE_COLORS = {
+    "narrator": Fore.MAGENTA,
+    "critic": Fore.CYAN,
+    "director": Fore.YELLOW
+}
+
+# ===== 簡易進行指示（ルールベース） =====
+DIRECTOR_INSTRUCTIONS = [
+    {
+        "to": "narrator",
+        "emotion": "defensive",
+        "style": "short",
+        "instruction": "批判に対して短く言い訳する"
+    },
+    {
+        "to": "narrator",
+        "emotion": "angry",
+        "style": "long",
+        "instruction": "感情的に長く反論する"
+    },
+    {
+        "to": "critic",
+        "emotion": "dismissive",
+        "style": "one_word",
+        "instruction": "一言で切り捨てる"
+    }
+]
+
 def test_ollama_connection(config: SystemConfig):
     """Ollama接続テスト"""
     console.print("\n[bold cyan]🔍 Ollama接続テスト開始[/bold cyan]")
     
     try:
-        # モデルリスト取得
-        response = ollama.list()
+        # モデルリスト取得（設定した接続先に問い合わせる）
+        response = ollama.Client(host=config.ollama_host).list()
         
         table = Table(title="利用可能なモデル")
         table.add_column("モデル名", style="cyan")
@@ -112,54 +160,86 @@ class SimpleDialogueTest:
     def __init__(self, config: SystemConfig):
         self.config = config
         self.conversation_history = []
+        # 指示は順番に巡回させ、同じ実行順なら同じプロンプトになるようにする
+        self._instructions = itertools.cycle(DIRECTOR_INSTRUCTIONS)
+        # 非同期クライアント（独立した呼び出しはサーバー側で並行処理される）
+        self._aclient = ollama.AsyncClient(host=config.ollama_host)
+        # 役割ごとのモデル名（呼び出しのたびに組み立てない）
+        self._model_map = {
+            'narrator': config.model_narrator,
+            'critic': config.model_critic,
+            'director': config.model_director
+        }
         
-    def get_response(self, role: str, prompt: str, system_prompt: str = None):
-        """単一の応答を取得"""
+    async def get_response(self, role: str, prompt: str, system_prompt: str = None,
+                           history: Optional[List[Dict]] = None):
+        """単一の応答を取得
+        
+        メッセージは システム→過去のやり取り→今回の入力 の順に並べる。
+        前回と同じ先頭部分はOllama側のKVキャッシュがそのまま再利用される。
+        応答は生成されたそばから役割の色で表示する。
+        """
         try:
             messages = []
             if system_prompt:
                 messages.append({'role': 'system', 'content': system_prompt})
+            if history:
+                messages.extend(history)
             messages.append({'role': 'user', 'content': prompt})
             
-            model_map = {
-                'narrator': self.config.model_narrator,
-                'critic': self.config.model_critic,
-                'director': self.config.model_director
-            }
-            
-            response = ollama.chat(
-                model=model_map[role],
-                messages=messages
+            stream = await self._aclient.chat(
+                model=self._model_map[role],
+                messages=messages,
+                stream=True,
+                keep_alive=self.config.keep_alive
             )
             
-            return response['message']['content']
+            color = ROLE_COLORS.get(role, "")
+            parts = []
+            async for chunk in stream:
+                piece = chunk['message']['content']
+                parts.append(piece)
+                print(f"{color}{piece}", end="", flush=True)
+            print(Style.RESET_ALL)
+            
+            return "".join(parts)
             
         except Exception as e:
             console.print(f"[red]エラー ({role}): {e}[/red]")
             return None
     
-    def run_test_conversation(self, theme: str, turns: int = 3):
-        """テスト会話を実行"""
+    async def warm_up(self, model: str):
+        """モデルを事前に読み込む（生成はしない）"""
+        try:
+            await self._aclient.generate(model=model, prompt="", keep_alive=self.config.keep_alive)
+        except Exception as e:
+            console.print(f"[dim]ウォームアップ失敗 ({model}): {e}[/dim]")
+    
+    async def run_test_conversation(self, theme: str, turns: int = 3):
+        """テスト会話を実行
+        
+        語り→批評→語りは前の応答に依存するため順番に呼び出す。
+        批評のモデルが語りと異なる場合は、最初の語りと並行して読み込んでおく。
+        """
         console.print(Panel(f"[bold green]テーマ: {theme}[/bold green]", expand=False))
         
         # 初回の語り
         console.print("\n[bold magenta]語り担当:[/bold magenta]")
-        narrator_response = self.get_response(
-            'narrator',
-            f"次のテーマで物語を始めてください: {theme}",
-            PROMPTS['narrator']
-        )
-        console.print(f"{Fore.MAGENTA}{narrator_response}{Style.RESET_ALL}")
+        narrator_prompt = f"次のテーマで物語を始めてください: {theme}"
+        narrator_task = self.get_response('narrator', narrator_prompt, PROMPTS['narrator'])
+        if self.config.model_critic != self.config.model_narrator:
+            narrator_response, _ = await asyncio.gather(narrator_task, self.warm_up(self.config.model_critic))
+        else:
+            narrator_response = await narrator_task
         self.conversation_history.append({'role': 'narrator', 'content': narrator_response})
         
         # 批評
         console.print("\n[bold cyan]批評担当:[/bold cyan]")
-        critic_response = self.get_response(
+        critic_response = await self.get_response(
             'critic',
             f"次の語りを批評してください（時に理不尽に）:\n{narrator_response}",
             PROMPTS['critic']
         )
-        console.print(f"{Fore.CYAN}{critic_response}{Style.RESET_ALL}")
         self.conversation_history.append({'role': 'critic', 'content': critic_response})
         
         # 進行担当の分析（簡易版）
@@ -169,42 +249,53 @@ class SimpleDialogueTest:
         
         # 指示を受けた語りの応答
         console.print("\n[bold magenta]語り担当（指示適用後）:[/bold magenta]")
-        narrator_response2 = self.get_response(
+        # 初回の語りをそのまま前置きにして、変わる部分（批評と指示）だけを末尾に付ける
+        narrator_response2 = await self.get_response(
             'narrator',
             f"批評: {critic_response}\n\n進行指示: {json.dumps(director_instruction)}\n\nこの指示に従って応答してください。",
-            PROMPTS['narrator']
+            PROMPTS['narrator'],
+            history=[
+                {'role': 'user', 'content': narrator_prompt},
+                {'role': 'assistant', 'content': narrator_response or ""}
+            ]
         )
-        console.print(f"{Fore.MAGENTA}{narrator_response2}{Style.RESET_ALL}")
         
         return self.conversation_history
     
     def get_director_instruction_simple(self):
         """簡易的な進行指示（ルールベース）"""
         # 後でLLMベースに置き換え
-        import random
-        
-        instructions = [
-            {
-                "to": "narrator",
-                "emotion": "defensive",
-                "style": "short",
-                "instruction": "批判に対して短く言い訳する"
-            },
-            {
-                "to": "narrator",
-                "emotion": "angry",
-                "style": "long",
-                "instruction": "感情的に長く反論する"
-            },
-            {
-                "to": "critic",
-                "emotion": "dismissive",
-                "style": "one_word",
-                "instruction": "一言で切り捨てる"
-            }
-        ]
-        
-        return random.choice(instructions)
+        return next(self._instructions)
+
+def show_gpu_status():
+    """GPUの名前・メモリ使用量・温度を表示"""
+    if pynvml is not None:
+        try:
+            pynvml.nvmlInit()
+            try:
+                for i in range(pynvml.nvmlDeviceGetCount()):
+                    handle = pynvml.nvmlDeviceGetHandleByIndex(i)
+                    name = pynvml.nvmlDeviceGetName(handle)
+                    if isinstance(name, bytes):
+                        name = name.decode()
+                    mem = pynvml.nvmlDeviceGetMemoryInfo(handle)
+                    temp = pynvml.nvmlDeviceGetTemperature(handle, pynvml.NVML_TEMPERATURE_GPU)
+                    console.print(f"{name}, {mem.used // 2**20}, {mem.total // 2**20}, {temp}")
+            finally:
+                pynvml.nvmlShutdown()
+            return
+        except pynvml.NVMLError as e:
+            console.print(f"[dim]NVMLからGPU情報を取得できません: {e}[/dim]")
+    
+    # シェルを介さず直接実行。nvidia-smiが無い環境では飛ばす
+    if shutil.which("nvidia-smi"):
+        subprocess.run(
+            ["nvidia-smi", "--query-gpu=name,memory.used,memory.total,temperature.gpu",
+             "--format=csv,noheader,nounits"],
+            check=False
+        )
+    else:
+        console.print("[dim]nvidia-smi が見つかりません（GPU情報をスキップ）[/dim]")
 
 # ===== メイン実行 =====
 def main():
@@ -246,25 +337,31 @@ def main():
     
     # テスト実行
     tester = SimpleDialogueTest(config)
-    history = tester.run_test_conversation(theme, turns=1)
+    history = asyncio.run(tester.run_test_conversation(theme, turns=1))
     
     # 結果保存
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     output_file = f"{config.output_dir}/test_{timestamp}.json"
     
+    result = {
+        'theme': theme,
+        'timestamp': timestamp,
+        'conversation': history
+    }
+    
     os.makedirs(config.output_dir, exist_ok=True)
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump({
-            'theme': theme,
-            'timestamp': timestamp,
-            'conversation': history
-        }, f, ensure_ascii=False, indent=2)
+    if orjson is not None:
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
+    else:
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
     
     console.print(f"\n[green]✅ テスト完了！結果を保存: {output_file}[/green]")
     
     # GPU状態確認
     console.print("\n[bold cyan]📊 GPU状態確認[/bold cyan]")
-    os.system("nvidia-smi --query-gpu=name,memory.used,memory.total,temperature.gpu --format=csv,noheader,nounits")
+    show_gpu_status()
     
     return 0
 